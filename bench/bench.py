@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+#   -*- coding: utf-8 -*-
+#   benchmark runner for 'poc' modeling program
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Run the poc benchmark suite, or compare two sets of results
+
+  bench.py run [-o results.json] [-r REPEAT] [names...]
+  bench.py compare baseline.json results.json [-t THRESHOLD]
+
+Each benchmark runs `poc --no-cache --profile` in a fresh process.  The
+results record the wall time, the peak RSS and the time spent in each
+phase (exec, boolean, tessellation, write) as reported by the profiler.
+
+The startup benchmarks run a trivial model with a private cache directory
+instead, so all but the first run find the compiled .poc file in it; their
+wall time is what a small part in a batch job costs.
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import glob
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+here = os.path.join(top, "bench")
+
+# name, .poc file, arguments
+suite = [
+    ("union-boxes-50", "union_boxes.poc", ["50"]),
+    ("union-boxes-200", "union_boxes.poc", ["200"]),
+    ("cylinder-grid-10", "cylinder_grid.poc", ["10"]),
+    ("cylinder-grid-30", "cylinder_grid.poc", ["30"]),
+    ("fillets-10", "fillets.poc", ["10"]),
+    ("fillets-40", "fillets.poc", ["40"]),
+    ("helix-pipe-10", "helix_pipe.poc", ["10"]),
+    ("helix-pipe-50", "helix_pipe.poc", ["50"]),
+    ("fine-stl-.01", "fine_stl.poc", [".01"]),
+    ("fine-stl-.002", "fine_stl.poc", [".002"]),
+    ("startup-trivial", "trivial.poc", []),
+]
+# benchmarks which run with a warm cache
+startup = set(["startup-trivial"])
+suite += [("example-" + os.path.splitext(os.path.basename(f))[0], f, [])
+    for f in sorted(glob.glob(os.path.join(top, "examples", "*.poc")))]
+
+def run_one(filename, args, repeat, cached=False):
+    """Run one benchmark `repeat` times and keep the fastest run"""
+    best = None
+    d = tempfile.mkdtemp()
+    try:
+        prefix = os.path.join(d, "profile")
+        if cached:
+            cache = ["--cache-dir", os.path.join(d, "cache")]
+        else:
+            cache = ["--no-cache"]
+        for i in range(repeat):
+            cmd = [sys.executable, os.path.join(top, "poc")] + cache + [
+                "--profile-prefix", prefix, "-o", os.path.join(d, "out.stl"),
+                os.path.join(here, filename)] + args
+            t0 = timeit.default_timer()
+            subprocess.check_call(cmd, cwd=d)
+            wall = timeit.default_timer() - t0
+            with open(prefix + ".json") as f:
+                profile = json.load(f)
+            result = {
+                'wall': wall,
+                'peak_rss_kb': profile['peak_rss_kb'],
+                'phases': profile['phases'],
+                'stats': profile['stats'],
+            }
+            if best is None or wall < best['wall']:
+                best = result
+    finally:
+        shutil.rmtree(d)
+    return best
+
+def run(options):
+    selected = [b for b in suite if not options.names or b[0] in options.names]
+    results = {}
+    for name, filename, args in selected:
+        print("%-24s" % name, end="")
+        sys.stdout.flush()
+        r = results[name] = run_one(filename, args, options.repeat,
+            name in startup)
+        print("%8.3fs %8dkB" % (r['wall'], r['peak_rss_kb'] or 0))
+    with open(options.output, "w") as f:
+        json.dump({
+            'python': sys.version,
+            'platform': platform.platform(),
+            'results': results,
+        }, f, indent=1, sort_keys=True)
+
+def compare(options):
+    with open(options.baseline) as f:
+        baseline = json.load(f)['results']
+    with open(options.results) as f:
+        results = json.load(f)['results']
+    regressions = 0
+    for name in sorted(set(baseline) & set(results)):
+        old = baseline[name]
+        new = results[name]
+        flags = []
+        for what, o, n in [('wall', old['wall'], new['wall']),
+                ('rss', old['peak_rss_kb'], new['peak_rss_kb'])] + [
+                (p, old['phases'].get(p), new['phases'].get(p))
+                    for p in sorted(new['phases'])]:
+            # ignore phases too short to measure reliably
+            if not o or not n or (what != 'rss' and max(o, n) < .05): continue
+            if n > o * (1 + options.threshold):
+                flags.append("%s +%.0f%%" % (what, (n / o - 1) * 100))
+        regressions += bool(flags)
+        print("%-24s %8.3fs -> %8.3fs %s" % (name, old['wall'], new['wall'],
+            "REGRESSION: " + ", ".join(flags) if flags else ""))
+    for name in sorted(set(baseline) - set(results)):
+        print("%-24s missing from results" % name)
+    if regressions:
+        raise SystemExit("%d benchmark(s) regressed" % regressions)
+
+parser = argparse.ArgumentParser(description="poc benchmark suite")
+sub = parser.add_subparsers(dest="command")
+p = sub.add_parser("run", help="run the benchmarks")
+p.add_argument("-o", "--output", default="bench-results.json",
+    help="results file (default: bench-results.json)")
+p.add_argument("-r", "--repeat", type=int, default=3,
+    help="runs of each benchmark; the fastest is kept (default: 3)")
+p.add_argument("names", nargs="*", help="benchmarks to run (default: all)")
+p.set_defaults(func=run)
+p = sub.add_parser("compare", help="flag regressions against a baseline")
+p.add_argument("baseline")
+p.add_argument("results")
+p.add_argument("-t", "--threshold", type=float, default=.1,
+    help="fractional slowdown to flag as a regression (default: .1)")
+p.set_defaults(func=compare)
+p = sub.add_parser("list", help="list the benchmarks")
+p.set_defaults(func=lambda options: print("\n".join(b[0] for b in suite)))
+
+if __name__ == '__main__':
+    options = parser.parse_args()
+    if not options.command:
+        parser.error("a command is required")
+    options.func(options)
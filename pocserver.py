@@ -0,0 +1,393 @@
+#! python -*- coding: utf-8 -*-
+#   file watching and build server for 'poc' modeling program
+
+#   Copyright © 2017 Jeff Epler <jepler@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Services for the poc programs which .poc files do not need: noticing
+changes to files, for pocview, and building files sent over HTTP, for
+``poc --serve`` and ``poc --remote``
+
+These are kept out of poctools so that executing a .poc file does not
+load the HTTP modules."""
+
+from __future__ import print_function
+
+import binascii
+import collections
+import errno
+import hashlib
+import hmac
+import io
+import json
+import os
+import poctools
+import shutil
+import six
+import six.moves.BaseHTTPServer as BaseHTTPServer
+import six.moves.queue
+import six.moves.socketserver as socketserver
+import six.moves.urllib.error
+import six.moves.urllib.request
+import socket
+import struct
+import sys
+import tempfile
+import threading
+
+### File watching
+
+# inotify(7) flags
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_Q_OVERFLOW = 0x4000
+_IN_CLOEXEC = 0o2000000
+_IN_MASK = (_IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE
+    | _IN_DELETE)
+
+def _inotify():
+    """Return the C library if it provides inotify, or None"""
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch, libc.inotify_rm_watch
+        return libc
+    except (ImportError, OSError, AttributeError):
+        return None
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+class Watcher(object):
+    """Notices changes to a set of files
+
+On Linux this uses inotify on the directories holding the files, so that
+a file replaced by an editor's save-by-rename is still seen, and `poll`
+costs one system call however many files are watched.  Elsewhere `poll`
+compares the files' modification times."""
+    def __init__(self, paths=()):
+        self.fd = None
+        self.paths = set()
+        self.dirs = {}
+        self.names = {}
+        self.mtimes = {}
+        self.libc = _inotify()
+        if self.libc:
+            fd = self.libc.inotify_init1(os.O_NONBLOCK | _IN_CLOEXEC)
+            if fd >= 0: self.fd = fd
+        self.watch(paths)
+
+    def watch(self, paths):
+        """Watch `paths` instead of the files watched before"""
+        self.paths = set(os.path.realpath(p) for p in paths)
+        if self.fd is None:
+            self.mtimes = dict((p, _mtime(p)) for p in self.paths)
+            return
+        dirs = set(os.path.dirname(p) for p in self.paths)
+        for d in set(self.dirs) - dirs:
+            self.libc.inotify_rm_watch(self.fd, self.dirs.pop(d))
+        for d in dirs - set(self.dirs):
+            name = d.encode(sys.getfilesystemencoding()) \
+                if isinstance(d, six.text_type) else d
+            wd = self.libc.inotify_add_watch(self.fd, name, _IN_MASK)
+            if wd >= 0: self.dirs[d] = wd
+        self.names = dict((wd, d) for d, wd in self.dirs.items())
+
+    def poll(self):
+        """Return True if any watched file changed since the last poll"""
+        if self.fd is None:
+            mtimes = dict((p, _mtime(p)) for p in self.paths)
+            changed = mtimes != self.mtimes
+            self.mtimes = mtimes
+            return changed
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK): break
+                raise
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, length = struct.unpack_from("iIII", data, pos)
+                name = data[pos + 16:pos + 16 + length].rstrip(b"\0")
+                pos += 16 + length
+                if mask & _IN_Q_OVERFLOW:
+                    changed = True
+                    continue
+                d = self.names.get(wd)
+                if d is None: continue
+                if six.PY3: name = os.fsdecode(name)
+                if os.path.join(d, name) in self.paths: changed = True
+        return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+### Build server
+
+class _HTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class _HTTPServer6(_HTTPServer):
+    address_family = socket.AF_INET6
+
+class _BuildHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def allowed(self):
+        """Refuse requests which could come from a web page: those naming
+another host (DNS rebinding) or lacking the server's token"""
+        builder = self.server.builder
+        hosts = ["%s:%d" % (h, builder.address[1])
+            for h in ('localhost', '127.0.0.1', '[::1]')]
+        if self.headers.get('Host') not in hosts:
+            self.send_error(403, "bad Host")
+            return False
+        token = self.headers.get('X-Poc-Token', '')
+        if not hmac.compare_digest(token.encode('utf-8'),
+                builder.token.encode('ascii')):
+            self.send_error(403, "bad token")
+            return False
+        return True
+
+    def do_GET(self):
+        if self.path != '/status':
+            return self.send_error(404)
+        if not self.allowed(): return
+        self.reply(200, json.dumps(self.server.builder.status()).encode(
+            'utf-8'), 'application/json')
+
+    def do_POST(self):
+        if self.path != '/build':
+            return self.send_error(404)
+        if not self.allowed(): return
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.split(';')[0].strip() != 'application/json':
+            return self.send_error(415, "expected application/json")
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            source = request['source']
+            args = [str(a) for a in request.get('args', [])]
+            name = os.path.basename(request.get('name', 'model.poc'))
+            fmt = request.get('format', 'stl')
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            return self.reply(400, ("bad request: %s\n" % e).encode('utf-8'))
+        status, body, cached = self.server.builder.build(source, args, name,
+            fmt)
+        self.reply(status, body,
+            'application/octet-stream' if status == 200 else 'text/plain',
+            cached)
+
+    def reply(self, status, body, content_type='text/plain', cached=False):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if cached: self.send_header('X-Poc-Cached', 'yes')
+        self.end_headers()
+        self.wfile.write(body)
+
+_loopback = ('localhost', '127.0.0.1', '::1')
+
+def parse_address(address):
+    """Return (host, port) for an address given as 'host:port' or 'port'
+
+The host must be a loopback address."""
+    host, _, port = address.rpartition(':')
+    host = host.strip('[]') or 'localhost'
+    if host not in _loopback:
+        raise ValueError("%s: the build server only listens on the loopback "
+            "interface" % address)
+    return host, int(port)
+
+def token_path(port):
+    """Return the file holding the token of the build server on `port`"""
+    return os.path.join(poctools.default_cache_dir(), "server-%d.token" % port)
+
+class BuildServer(object):
+    """Builds .poc files sent over HTTP in a pool of warm worker processes
+
+POST /build with a JSON object holding the file's 'source', and
+optionally the rest of its 'args', its file 'name' and the output
+'format' (stl, brep, ply, obj or 3mf).  The response is the model.  An
+error in the file gives status 500 and the traceback; status 503 means
+no worker became free, and 504 that the build did not finish, within
+`timeout` seconds.  GET /status describes the server.
+
+The server runs any Python it is sent, so it only listens on a loopback
+address, and each request must carry the header X-Poc-Token with the
+token the server writes, readable only by its user, to `token_path`.
+At most `workers` files are built at once.  Results are kept, up to
+`cache_size` bytes, keyed by a hash of the source, arguments and format,
+until a module which the file imported changes."""
+    def __init__(self, address=('localhost', 8470), workers=1, timeout=60,
+            cache_size=256<<20):
+        if address[0] not in _loopback:
+            raise ValueError("the build server only listens on the "
+                "loopback interface")
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.results = collections.OrderedDict()
+        self.size = 0
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+        # Load the kernel before forking so that every worker starts warm
+        for m in ('TopoDS', 'BRepPrimAPI', 'BRepAlgoAPI', 'BRepMesh',
+                'StlAPI', 'BinTools', 'BRepTools'):
+            getattr(poctools.OCC, m)
+        self.workers = workers
+        self.idle = six.moves.queue.Queue()
+        for i in range(workers):
+            self.idle.put(poctools.Worker())
+        server = _HTTPServer6 if ':' in address[0] else _HTTPServer
+        self.httpd = server(address, _BuildHandler)
+        self.httpd.builder = self
+        self.address = self.httpd.server_address
+        self.token = binascii.hexlify(os.urandom(16)).decode('ascii')
+        self.token_path = token_path(self.address[1])
+        try:
+            os.makedirs(os.path.dirname(self.token_path))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(self.token_path)): raise
+        if os.path.exists(self.token_path): os.remove(self.token_path)
+        fd = os.open(self.token_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+            0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(self.token)
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def close(self):
+        self.httpd.server_close()
+        try:
+            os.remove(self.token_path)
+        except OSError:
+            pass
+        while not self.idle.empty():
+            self.idle.get().close()
+
+    def status(self):
+        return {
+            'workers': self.workers,
+            'idle': self.idle.qsize(),
+            'results': len(self.results),
+            'result bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def build(self, source, args=(), name='model.poc', fmt='stl'):
+        """Build a .poc file from its `source`
+
+Returns (HTTP status, body, whether the result came from the cache)."""
+        if '.' + fmt not in poctools._writers:
+            return 400, ("unknown format %r\n" % fmt).encode('utf-8'), False
+        key = hashlib.sha1(repr((source, list(args), name, fmt))
+            .encode('utf-8')).hexdigest()
+        with self.lock:
+            entry = self.results.pop(key, None)
+            if entry is not None:
+                if all(_mtime(p) == m for p, m in entry[1]):
+                    self.results[key] = entry
+                    self.hits += 1
+                    return 200, entry[0], True
+                self.size -= len(entry[0])
+            self.misses += 1
+        try:
+            worker = self.idle.get(timeout=self.timeout)
+        except six.moves.queue.Empty:
+            return 503, b"no worker became free\n", False
+        d = tempfile.mkdtemp()
+        try:
+            if not worker.process.is_alive():
+                worker = self.replace(worker)
+            filename = os.path.join(d, name)
+            with io.open(filename, "w", encoding="utf-8") as f:
+                f.write(six.text_type(source))
+            try:
+                worker.submit([filename] + list(args),
+                    __output__=os.path.splitext(filename)[0] + "." + fmt)
+                result = worker.result(self.timeout)
+            except (EOFError, IOError, OSError):
+                # the worker died, e.g. from a crash in the kernel
+                worker = self.replace(worker)
+                return 500, b"the worker building this file died\n", False
+            if result is None:
+                worker.cancel()
+                try:
+                    stopped = worker.result(1) is not None
+                except (EOFError, IOError, OSError):
+                    stopped = False
+                if not stopped:
+                    worker = self.replace(worker)
+                return 504, b"build timed out\n", False
+            status, value = result
+            if status != 'ok':
+                return 500, value.encode('utf-8'), False
+            with open(value, "rb") as f:
+                data = f.read()
+            stamps = [(p, _mtime(p)) for p in worker.depends
+                if not p.startswith(d + os.sep)]
+            self.store(key, data, stamps)
+            return 200, data, False
+        finally:
+            self.idle.put(worker)
+            shutil.rmtree(d, ignore_errors=True)
+
+    def replace(self, worker):
+        """Stop `worker` and return a new one to take its place"""
+        worker.close()
+        return poctools.Worker()
+
+    def store(self, key, data, stamps):
+        with self.lock:
+            old = self.results.pop(key, None)
+            if old is not None: self.size -= len(old[0])
+            self.results[key] = (data, stamps)
+            self.size += len(data)
+            while self.size > self.cache_size:
+                data, stamps = self.results.popitem(last=False)[1]
+                self.size -= len(data)
+
+def remote_build(address, filename, args=(), fmt='stl', timeout=None):
+    """Build the .poc file `filename` on the `BuildServer` at `address`
+('host:port') and return the model in format `fmt` as bytes"""
+    host, port = parse_address(address)
+    with open(token_path(port)) as f:
+        token = f.read().strip()
+    body = json.dumps({
+        'source': poctools.getsource(filename),
+        'args': list(args),
+        'name': os.path.basename(filename),
+        'format': fmt,
+    }).encode('utf-8')
+    if ':' in host: host = "[%s]" % host
+    request = six.moves.urllib.request.Request(
+        "http://%s:%d/build" % (host, port), body,
+        {'Content-Type': 'application/json', 'X-Poc-Token': token})
+    try:
+        return six.moves.urllib.request.urlopen(request,
+            timeout=timeout).read()
+    except six.moves.urllib.error.HTTPError as e:
+        raise RuntimeError("%s: %d %s" % (address, e.code,
+            e.read().decode('utf-8', 'replace')))
@@ -16,40 +16,48 @@
 #   You should have received a copy of the GNU General Public License
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import contextlib
 import __future__
+import functools
+import hashlib
+import importlib
+import io
 import itertools
+import json
+import marshal
 import math
 import os
+import pickle
 import six
 import shutil
 import struct
 import sys
 import tempfile
+import threading
+import timeit
 import traceback
+import types
 
-import OCC.BRepAlgo
-import OCC.BRepAlgoAPI
-import OCC.BRepBuilderAPI
-import OCC.BRepBndLib
-import OCC.BRepFilletAPI
-import OCC.BRepGProp
-import OCC.BRepLib
-import OCC.BRepOffsetAPI
-import OCC.BRepPrimAPI
-import OCC.BRepTools
-import OCC.Bnd
-import OCC.GC
-import OCC.GCE2d
-import OCC.Geom
-import OCC.Geom2d
-import OCC.gp
-import OCC.GProp
-import OCC.StlAPI
-import OCC.TopAbs
-import OCC.TopExp
-import OCC.TopTools
-import OCC.TopoDS
+class _LazyPackage(object):
+    """Stands in for a package, importing each submodule when first used
+
+Loading all of OCC's extension modules takes much longer than running a
+small .poc file, and most files only need a few of them."""
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'): raise AttributeError(attr)
+        try:
+            value = importlib.import_module(self._name + "." + attr)
+        except ImportError:
+            # not a submodule, such as OCC.VERSION
+            value = getattr(importlib.import_module(self._name), attr)
+        setattr(self, attr, value)
+        return value
+
+OCC = _LazyPackage('OCC')
 
 def _dir(x):
     if isinstance(x, (tuple, list)):
@@ -90,24 +98,25 @@ __all__ = [
     'Chamfer', 'Fillet', 'Rotate', 'Translate', 'Transform',
     'Chamfered', 'Filleted', 'Rotated', 'Translated', 'Transformed',
     'Intersection', 'Difference', 'Union', 'Op',
+    'LinearPattern', 'PolarPattern', 'GridPattern',
     'Object', 'Bbox', 'CenterOfMass', 'CentreOfMass',
-    'Edges', 'Faces', 'Vertices', 'Wires',
+    'Edges', 'Faces', 'Vertices', 'Wires', 'Topology', 'TopologyIndex',
+    'AdjacentFaces', 'EdgesBetween', 'ConvexEdges', 'ConcaveEdges',
     'Matrix', 'Vertex', 'Edge', 'Wire', 'Face',
     'execpoc', 'occ_to_stl', 'do_op',
 ]
 
 ### Supporting routines
 def initial_ns():
-    ns = {
+    ns = dict((k, v) for k, v in vars(math).items() if not k.startswith('_'))
+    g = globals()
+    ns.update((k, g[k]) for k in __all__)
+    ns.update({
         '__builtins__': __builtins__,
         '__name__': '__main__',
         '__doc__': None,
         '__package__': None
-    }
-    six.exec_("""if 1:
-        from math import *
-        from poctools import *
-        """,  ns)
+    })
     return ns
 
 compile_flags = (__future__.division.compiler_flag
@@ -117,60 +126,444 @@ def getsource(filename):
     with open(filename, "rU") as f:
         return f.read()
 
+_compiled = {}
+
+def _compile(source, filename):
+    """Compile the .poc `source`, reusing the code object from an earlier
+run if the source, filename and flags are the same
+
+Code objects are kept in memory and, when there is a shape cache, in its
+directory."""
+    key = hashlib.sha1(repr((source, filename, compile_flags,
+        sys.version)).encode('utf-8')).hexdigest()
+    code = _compiled.get(key)
+    if code is not None: return code
+    path = cache and os.path.join(cache.directory, key + ".pyc")
+    if path:
+        try:
+            with open(path, "rb") as f:
+                code = marshal.loads(f.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            pass
+    if code is None:
+        code = compile(source, filename, 'exec', compile_flags)
+        if path:
+            tmp = "%s.%d.%d.tmp" % (path, os.getpid(),
+                threading.current_thread().ident)
+            with open(tmp, "wb") as f:
+                f.write(marshal.dumps(code))
+            os.rename(tmp, path)
+    _compiled[key] = code
+    return code
+
+def _builtins(imported):
+    """Return builtins for a .poc file which add the names of the modules
+it imports to the set `imported`"""
+    result = dict(vars(six.moves.builtins))
+    real_import = result['__import__']
+    def __import__(name, *args, **kw):
+        imported.add(name)
+        fromlist = args[2] if len(args) > 2 else kw.get('fromlist')
+        for item in fromlist or ():
+            imported.add(name + "." + item)
+        return real_import(name, *args, **kw)
+    result['__import__'] = __import__
+    return result
+
+# Held while execpoc has replaced sys.argv
+_argv_lock = threading.RLock()
+
 def execpoc(args, **kw):
     """Execute the named .poc file from disk
 
+The file, and anything it calls, sees `args` as sys.argv; the file also
+gets them as __args__.  As sys.argv belongs to the whole process, files
+executed on several threads at once take turns.
 Returns the resulting top level object"""
 
-    oldargv = sys.argv[:]
-    try:
-        filename = args[0]
-        code = compile(getsource(filename), filename, 'exec', compile_flags)
-        sys.argv[:] = args
-        ns = initial_ns()
-        ns['__file__'] = filename
-        ns.update(kw)
-        start()
-        six.exec_(code, ns)
-        return ns
-    finally: sys.argv[:] = oldargv
+    filename = args[0]
+    code = _compile(getsource(filename), filename)
+    ns = initial_ns()
+    ns['__file__'] = filename
+    ns.update(kw)
+    with _argv_lock:
+        oldargv = sys.argv[:]
+        try:
+            sys.argv[:] = args
+            start()
+            c = current_context()
+            c.argv = ns['__args__'] = list(args)
+            imported = set()
+            ns['__builtins__'] = _builtins(imported)
+            t0 = timeit.default_timer()
+            m0 = profiler and profiler.measured
+            six.exec_(code, ns)
+            _flush()
+            if profiler:
+                # Operations run by the file are already counted in their
+                # phases
+                profiler.phases['exec'] += (timeit.default_timer() - t0
+                    - (profiler.measured - m0))
+        finally: sys.argv[:] = oldargv
+    ns['__depends__'] = _dependencies(filename, ns, imported)
+    return ns
  
 def do_op(b):
     """Adds the object 'b' to the current operation"""
     if b is None:
         raise ValueError
-    n = next(op)
-    n(obj, b)
+    c = current_context()
+    n = next(c.op)
+    n(c.obj, b)
 
 def _assign(a, b):
-    global obj
-    obj = b
+    current_context().obj = b
 
 def _fuse(a, b):
-    global obj
-    obj = OCC.BRepAlgoAPI.BRepAlgoAPI_Fuse(a, b).Shape()
+    _defer('fuse', b)
 
 def _common(a, b):
-    global obj
-    obj = OCC.BRepAlgoAPI.BRepAlgoAPI_Common(a, b).Shape()
+    # Not deferred: with several tools, OCC's common is a ∩ (b ∪ c ∪ ...)
+    current_context().obj = _make('common', _build_boolean, 'common',
+        _current(), (b,))
 
 def _cut(a, b):
-    global obj
-    obj = OCC.BRepAlgoAPI.BRepAlgoAPI_Cut(a, b).Shape()
+    _defer('cut', b)
+
+def _defer(kind, b):
+    c = current_context()
+    c.pendingop = kind
+    c.pending.append(b)
+
+def _flush():
+    """Perform the boolean operation on the operands collected so far
+in the current group operation"""
+    c = current_context()
+    if c.pending:
+        tools = tuple(c.pending)
+        del c.pending[:]
+        c.obj = _make(c.pendingop, _build_boolean, c.pendingop, c.obj, tools)
+
+def _build_boolean(kind, shape, tools):
+    """Perform a boolean operation, skipping the kernel where the bounding
+boxes of the operands show what the result will be
+
+A cut by tools which miss the shape leaves it alone; a common of shapes
+which miss each other is empty; and members of a union which miss all
+the others are combined with it in a compound instead of being fused."""
+    stats = current_context().stats
+    # Drop empty operands, such as an empty group, as _operands does
+    if kind != 'common':
+        tools = [t for t in tools if not t.IsNull()]
+        if shape.IsNull():
+            if kind == 'cut' or not tools: return shape
+            shape, tools = tools[0], tools[1:]
+        if not tools: return shape
+    box = _bndbox(shape)
+    tools = list(tools)
+    if kind == 'cut':
+        hits = [t for t in tools if not box.IsOut(_bndbox(t))]
+        stats['tools skipped'] += len(tools) - len(hits)
+        tools = hits
+        if not tools:
+            stats['booleans skipped'] += 1
+            return shape
+    elif kind == 'common':
+        if any(box.IsOut(_bndbox(t)) for t in tools):
+            stats['booleans skipped'] += 1
+            return _compound([])
+    else:
+        operands = [shape] + tools
+        boxes = [box] + [_bndbox(t) for t in tools]
+        apart = []
+        for i, bi in enumerate(boxes):
+            apart.append(all(bi.IsOut(bj)
+                for j, bj in enumerate(boxes) if i != j))
+        loose = [o for o, a in zip(operands, apart) if a]
+        operands = [o for o, a in zip(operands, apart) if not a]
+        stats['tools skipped'] += len(loose)
+        if not operands:
+            stats['booleans skipped'] += 1
+            return _compound(loose)
+        shape = operands[0]
+        tools = operands[1:]
+        if loose:
+            return _compound([_build_boolean(kind, shape, tools)] + loose)
+    stats['booleans'] += 1
+    if kind == 'fuse':
+        builder = OCC.BRepAlgoAPI.BRepAlgoAPI_Fuse()
+    elif kind == 'cut':
+        builder = OCC.BRepAlgoAPI.BRepAlgoAPI_Cut()
+    else:
+        builder = OCC.BRepAlgoAPI.BRepAlgoAPI_Common()
+    arguments = OCC.TopTools.TopTools_ListOfShape()
+    arguments.Append(shape)
+    toollist = OCC.TopTools.TopTools_ListOfShape()
+    for t in tools:
+        toollist.Append(t)
+    builder.SetArguments(arguments)
+    builder.SetTools(toollist)
+    builder.SetRunParallel(True)
+    builder.Build()
+    return builder.Shape()
+
+def _compound(shapes):
+    builder = OCC.BRep.BRep_Builder()
+    result = OCC.TopoDS.TopoDS_Compound()
+    builder.MakeCompound(result)
+    for s in shapes:
+        builder.Add(result, s)
+    return result
 
 def op1(x):
     return iter(itertools.chain([_assign], itertools.repeat(x)))
 
+class Context(object):
+    """The state of one model as it is built: the current item, the
+operation which combines new items with it, and the counts and shapes
+kept for the run
+
+Each thread has its own current context, so independent models can be
+built on several threads at once (though `execpoc` runs one file at a
+time, as it sets the process-wide sys.argv).  A context is made current for the
+duration of a ``with`` statement::
+
+    with Context() as c:
+        execpoc([filename])
+    print(c.stats)
+"""
+    def __init__(self):
+        # Counts of kernel calls made and avoided during the current run
+        self.stats = collections.Counter()
+        # Shapes of deferred nodes by key, and the keys used this run
+        self.evaluated = {}
+        self.used = set()
+        # Whether the last run was in draft mode, and for each mode, the
+        # keys used by the last run in it
+        self.mode = None
+        self.modes = {}
+        # id(shape) -> (shape, digest), see `_digest`
+        self.digests = {}
+        self.topology = None
+        # The arguments of the .poc file being executed
+        self.argv = []
+        # Fonts and extruded glyphs used by Text, see `_glyph`
+        self.fonts = {}
+        self.glyphs = {}
+        self.saved = []
+        self.reset()
+
+    def reset(self):
+        """Start a new, empty model"""
+        self.obj = OCC.TopoDS.TopoDS_Shape()
+        self.op = op1(_fuse)
+        self.pending = []
+        self.pendingop = None
+
+    def __enter__(self):
+        self.saved.append(getattr(_local, 'context', None))
+        _local.context = self
+        return self
+
+    def __exit__(self, *exc):
+        _local.context = self.saved.pop()
+
+_local = threading.local()
+
+def current_context():
+    """Return the current thread's `Context`, making one if needed"""
+    c = getattr(_local, 'context', None)
+    if c is None:
+        c = _local.context = Context()
+    return c
+
 def start():
-    global obj, op
-    obj = OCC.TopoDS.TopoDS_Shape()
-    op = op1(_fuse)
+    c = current_context()
+    c.stats.clear()
+    if retain:
+        # Keep what the last run in each mode used, so that alternating
+        # draft and full runs (as pocview does) keep each other's shapes
+        if c.mode is not None: c.modes[c.mode] = c.used
+        keep = set()
+        for used in c.modes.values(): keep |= used
+        for key in set(c.evaluated) - keep:
+            del c.evaluated[key]
+        kept = set(id(s) for s in c.evaluated.values())
+        for i in set(c.digests) - kept:
+            del c.digests[i]
+    else:
+        c.digests.clear()
+        c.evaluated.clear()
+    c.used = set()
+    c.mode = draft
+    c.reset()
 
 def output(fn):
-    occ_to_stl(obj, fn)
-
-def occ_to_stl(obj, filename, prec=.05):
-    """Convert a solid to stl"""
+    """Write the current item to `fn` in the format given by its extension:
+.stl, .ply, .obj, .3mf or .brep"""
+    ext = os.path.splitext(fn)[1].lower()
+    _writers.get(ext, occ_to_stl)(Object(), fn)
+
+def occ_to_stl(obj, filename, prec=None, parallel=True):
+    """Convert a solid to stl
+
+`prec` is the maximum distance between the surface and its triangles.
+If it is None, it is `relative_deflection` (or in draft mode,
+`draft_deflection`) times the size of the solid.
+If `parallel` is true, faces are meshed on all available cores."""
+    prec = _deflection(obj, prec)
+    obj = _timed('mesh', _meshed, obj, prec, parallel)
+    _timed('stl', _write_stl, obj, filename, prec)
+
+# The deflection used when none is given, as a fraction of the length of
+# the diagonal of the model's bounding box
+relative_deflection = .0005
+draft_deflection = .005
+
+# In draft mode, finishing operations (fillets and chamfers) are skipped
+# and models are meshed coarsely, for quick previews
+draft = False
+
+def _deflection(shape, prec):
+    if prec is not None: return prec
+    box = _bndbox(shape)
+    if box.IsVoid(): return .05
+    lo = box.CornerMin()
+    hi = box.CornerMax()
+    diag = lo.Distance(hi)
+    return max(diag * (draft_deflection if draft else relative_deflection),
+        1e-4)
+
+def _meshed(shape, prec, parallel):
+    """Return `shape` with a triangulation of the given deflection
+
+Faces which already have a fine enough triangulation keep it; these
+are faces shared with shapes meshed earlier, for instance faces which a
+boolean operation left untouched.  If the whole shape was meshed in an
+earlier run, the meshed shape is loaded from the cache instead."""
+    stats = current_context().stats
+    key = cache and _key('mesh', (shape, prec))
+    if key:
+        meshed = cache.get(key)
+        if meshed is not None:
+            stats['meshes cached'] += 1
+            return meshed
+    faces = _unique(shape, OCC.TopAbs.TopAbs_FACE)
+    reused = sum(1 for f in faces if _triangulated(f, prec))
+    stats['faces meshed'] += len(faces) - reused
+    stats['faces reused'] += reused
+    OCC.BRepMesh.BRepMesh_IncrementalMesh(shape, prec, False, .5, parallel)
+    if key: cache.put(key, shape)
+    return shape
+
+def _unique(shape, topologyType):
+    m = OCC.TopTools.TopTools_IndexedMapOfShape()
+    OCC.TopExp.topexp.MapShapes(shape, topologyType, m)
+    return [m.FindKey(i) for i in range(1, m.Extent() + 1)]
+
+def _triangulated(face, prec):
+    loc = OCC.TopLoc.TopLoc_Location()
+    handle = OCC.BRep.BRep_Tool_Triangulation(OCC.TopoDS.topods.Face(face), loc)
+    return not handle.IsNull() and handle.GetObject().Deflection() <= prec
+
+def _face_triangulations(shape):
+    """Yield (face, location, Poly_Triangulation) for each meshed face
+of `shape`"""
+    for face in visit(shape, OCC.TopAbs.TopAbs_FACE, OCC.TopoDS.topods.Face):
+        loc = OCC.TopLoc.TopLoc_Location()
+        handle = OCC.BRep.BRep_Tool_Triangulation(face, loc)
+        if handle.IsNull(): continue
+        yield face, loc, handle.GetObject()
+
+def _fill_triangulation(face, loc, tri, points, triangles):
+    """Store the triangulation `tri` of `face` into the NumPy arrays
+`points` (NbNodes x 3) and `triangles` (NbTriangles x 3), in model
+coordinates"""
+    import numpy
+    n = tri.NbNodes()
+    nodes = tri.Nodes()
+    points[:] = numpy.fromiter((c for p in
+        (nodes.Value(i) for i in range(1, n + 1))
+        for c in (p.X(), p.Y(), p.Z())), numpy.float32, 3 * n).reshape(-1, 3)
+    if not loc.IsIdentity():
+        t = loc.Transformation()
+        m = numpy.array([[t.Value(i, j) for j in range(1, 5)]
+            for i in range(1, 4)], dtype=numpy.float32)
+        points[:] = points.dot(m[:, :3].T) + m[:, 3]
+    n = tri.NbTriangles()
+    values = tri.Triangles()
+    t = numpy.fromiter((c for i in range(1, n + 1)
+        for c in values.Value(i).Get()), numpy.int64, 3 * n).reshape(-1, 3)
+    if face.Orientation() == OCC.TopAbs.TopAbs_REVERSED:
+        t = t[:, ::-1]
+    triangles[:] = t - 1
+
+def _triangulations(shape):
+    """Yield the triangulation of each face of `shape` as NumPy arrays
+(points, triangles), in model coordinates"""
+    import numpy
+    for face, loc, tri in _face_triangulations(shape):
+        points = numpy.empty((tri.NbNodes(), 3), numpy.float32)
+        triangles = numpy.empty((tri.NbTriangles(), 3), numpy.int64)
+        _fill_triangulation(face, loc, tri, points, triangles)
+        yield points, triangles
+
+def tessellate(shape=None, prec=None):
+    """Mesh `shape` (by default, the current item) with the given deflection
+(by default, as chosen by `occ_to_stl`)
+
+Returns a pair of NumPy arrays (points, triangles) as by `read_stl`."""
+    if shape is None: shape = Object()
+    # StlAPI writes the triangles from C++ and NumPy reads them back in
+    # bulk, which is much quicker than reading each node of each
+    # Poly_Triangulation through the wrappers
+    with TemporaryDirectory() as d:
+        filename = os.path.join(d, "mesh.stl")
+        occ_to_stl(shape, filename, prec)
+        return read_stl(filename)
+
+def read_stl(filename):
+    """Read a binary STL file, as written by `occ_to_stl`
+
+Returns a pair of NumPy arrays (points, triangles): an N x 3 array of
+float32 vertex coordinates and an M x 3 array of int64 indices into
+`points`.  Corners with the same coordinates share a vertex."""
+    import numpy
+    record = numpy.dtype([('normal', '<f4', 3), ('corners', '<f4', (3, 3)),
+        ('attributes', '<u2')])
+    with open(filename, "rb") as f:
+        f.seek(80)
+        count, = struct.unpack("<I", f.read(4))
+        data = numpy.fromfile(f, record, count)
+    points, inverse = numpy.unique(data['corners'].reshape(-1, 3), axis=0,
+        return_inverse=True)
+    return points, inverse.reshape(-1, 3).astype(numpy.int64)
+
+def to_polydata(points, triangles):
+    """Wrap the result of `tessellate` or `read_stl` in a vtkPolyData
+
+The point coordinates are used by VTK in place, without a copy."""
+    import numpy
+    import vtk
+    from vtk.util import numpy_support
+    points = numpy.ascontiguousarray(points)
+    vpoints = vtk.vtkPoints()
+    vpoints.SetData(numpy_support.numpy_to_vtk(points, deep=False))
+    # vtkCellArray's legacy layout: a count before each cell's indices
+    cells = numpy.empty((len(triangles), 4), numpy_support.ID_TYPE_CODE)
+    cells[:, 0] = 3
+    cells[:, 1:] = triangles
+    polys = vtk.vtkCellArray()
+    polys.SetCells(len(triangles),
+        numpy_support.numpy_to_vtkIdTypeArray(cells.ravel(), deep=False))
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(vpoints)
+    polydata.SetPolys(polys)
+    # numpy_to_vtk keeps only `points` alive; keep `cells` alive too
+    polydata._cells = cells
+    return polydata
+
+def _write_stl(obj, filename, prec):
     w = OCC.StlAPI.StlAPI_Writer()
     w.SetASCIIMode(False)
     w.SetDeflection(prec)
@@ -178,21 +571,200 @@ def occ_to_stl(obj, filename, prec=.05):
     w.Write(obj, filename + ".tmp", True)
     os.rename(filename + ".tmp", filename)
 
+class _Welder(object):
+    """Gives the same index to vertices of different faces which are
+within `tolerance` of each other"""
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.index = {}
+        self.count = 0
+
+    def weld(self, points, triangles):
+        """Return the rows of `points` not seen before, and the index of
+every row of `points`
+
+Only the vertices on the boundary of the face, as given by `triangles`,
+are remembered for later faces."""
+        import numpy
+        q = numpy.round(points / self.tolerance).astype(numpy.int64)
+        # Weld within the face first, then look up what remains
+        q, first, inverse = numpy.unique(q, axis=0,
+            return_index=True, return_inverse=True)
+        inverse = inverse.ravel()
+        # A vertex is on the boundary if it ends an edge used by only one
+        # triangle
+        t = inverse[triangles]
+        e = numpy.sort(numpy.concatenate(
+            (t[:, [0, 1]], t[:, [1, 2]], t[:, [2, 0]])), axis=1)
+        e, counts = numpy.unique(e, axis=0, return_counts=True)
+        boundary = numpy.unique(e[counts == 1])
+        rows = [tuple(row) for row in q[boundary].tolist()]
+        ids = numpy.full(len(q), -1, numpy.int64)
+        for i, row in zip(boundary, rows):
+            ids[i] = self.index.get(row, -1)
+        new = numpy.flatnonzero(ids < 0)
+        ids[new] = numpy.arange(self.count, self.count + len(new))
+        self.count += len(new)
+        for i, row in zip(boundary, rows):
+            self.index[row] = ids[i]
+        return points[first[new]], ids[inverse]
+
+def _welded(obj, prec):
+    """Mesh `obj` and yield its faces one at a time as (points, triangles)
+
+The points are those not used by any earlier face, and the triangles
+index into all the points yielded so far."""
+    prec = _deflection(obj, prec)
+    obj = _timed('mesh', _meshed, obj, prec, True)
+    welder = _Welder(prec * 1e-3)
+    for points, triangles in _triangulations(obj):
+        points, ids = welder.weld(points, triangles)
+        t = ids[triangles]
+        t = t[(t[:, 0] != t[:, 1]) & (t[:, 1] != t[:, 2]) & (t[:, 2] != t[:, 0])]
+        yield points, t
+
+def occ_to_ply(obj, filename, prec=None):
+    """Convert a solid to binary ply, with vertices shared between triangles"""
+    _timed('ply', _write_ply, obj, filename, prec)
+
+def _write_ply(obj, filename, prec):
+    import numpy
+    face = numpy.dtype([('n', 'u1'), ('v', '<i4', 3)])
+    nv = nf = 0
+    with tempfile.TemporaryFile() as vf, tempfile.TemporaryFile() as ff:
+        for points, triangles in _welded(obj, prec):
+            vf.write(points.astype('<f4').tobytes())
+            t = numpy.empty(len(triangles), face)
+            t['n'] = 3
+            t['v'] = triangles
+            ff.write(t.tobytes())
+            nv += len(points)
+            nf += len(triangles)
+        with open(filename + ".tmp", "wb") as f:
+            f.write(("ply\nformat binary_little_endian 1.0\n"
+                "element vertex %d\n"
+                "property float x\nproperty float y\nproperty float z\n"
+                "element face %d\n"
+                "property list uchar int vertex_indices\n"
+                "end_header\n" % (nv, nf)).encode('ascii'))
+            for part in vf, ff:
+                part.seek(0)
+                shutil.copyfileobj(part, f)
+    os.rename(filename + ".tmp", filename)
+
+def occ_to_obj(obj, filename, prec=None):
+    """Convert a solid to Wavefront obj, with vertices shared between triangles"""
+    _timed('obj', _write_obj, obj, filename, prec)
+
+def _write_obj(obj, filename, prec):
+    import numpy
+    with open(filename + ".tmp", "wb") as f:
+        f.write(b"# written by poc\n")
+        for points, triangles in _welded(obj, prec):
+            numpy.savetxt(f, points, "v %.9g %.9g %.9g")
+            numpy.savetxt(f, triangles + 1, "f %d %d %d")
+    os.rename(filename + ".tmp", filename)
+
+def occ_to_3mf(obj, filename, prec=None, compress=True):
+    """Convert a solid to 3mf, with vertices shared between triangles
+
+If `compress` is true, the model inside the 3mf archive is compressed."""
+    _timed('3mf', _write_3mf, obj, filename, prec, compress)
+
+_3mf_content_types = b"""<?xml version="1.0" encoding="UTF-8"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+ <Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+ <Default Extension="model" ContentType="application/vnd.ms-package.3dmanufacturing-3dmodel+xml"/>
+</Types>
+"""
+
+_3mf_rels = b"""<?xml version="1.0" encoding="UTF-8"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+ <Relationship Target="/3D/3dmodel.model" Id="rel0" Type="http://schemas.microsoft.com/3dmanufacturing/2013/01/3dmodel"/>
+</Relationships>
+"""
+
+def _write_3mf(obj, filename, prec, compress):
+    import numpy
+    with TemporaryDirectory() as d:
+        model = os.path.join(d, "3dmodel.model")
+        with open(model, "wb") as f, tempfile.TemporaryFile() as tf:
+            f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n'
+                b'<model unit="millimeter" xml:lang="en-US" xmlns='
+                b'"http://schemas.microsoft.com/3dmanufacturing/core/2015/02">\n'
+                b'<resources><object id="1" type="model"><mesh><vertices>\n')
+            for points, triangles in _welded(obj, prec):
+                numpy.savetxt(f, points, '<vertex x="%.9g" y="%.9g" z="%.9g"/>')
+                numpy.savetxt(tf, triangles,
+                    '<triangle v1="%d" v2="%d" v3="%d"/>')
+            f.write(b'</vertices><triangles>\n')
+            tf.seek(0)
+            shutil.copyfileobj(tf, f)
+            f.write(b'</triangles></mesh></object></resources>\n'
+                b'<build><item objectid="1"/></build></model>\n')
+        import zipfile
+        method = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        with zipfile.ZipFile(filename + ".tmp", "w", method) as z:
+            z.writestr("[Content_Types].xml", _3mf_content_types)
+            z.writestr("_rels/.rels", _3mf_rels)
+            z.write(model, "3D/3dmodel.model")
+    os.rename(filename + ".tmp", filename)
+
+def occ_to_brep(obj, filename):
+    """Write a shape in OpenCASCADE's BRep format"""
+    _timed('brep', _write_brep, obj, filename)
+
+def _write_brep(obj, filename):
+    OCC.BRepTools.breptools.Write(obj, filename + ".tmp")
+    os.rename(filename + ".tmp", filename)
+
+_writers = {
+    '.brep': occ_to_brep,
+    '.stl': occ_to_stl,
+    '.ply': occ_to_ply,
+    '.obj': occ_to_obj,
+    '.3mf': occ_to_3mf,
+}
+
 @contextlib.contextmanager
-def withhelper(newop, newobj=None, finalop=None):
-    global obj, op
-    holdobj = obj
-    holdop = op
-    obj = newobj = newobj or OCC.TopoDS.TopoDS_Shape()
-    op = iter(newop)
+def withhelper(newop, newobj=None, finalop=None, instances=None):
+    c = current_context()
+    hold = c.obj, c.op, c.pending, c.pendingop
+    c.obj = newobj = newobj or OCC.TopoDS.TopoDS_Shape()
+    c.op = iter(newop)
+    c.pending = []
+    if profiler: profiler.blocks.append(_caller())
     try:
         yield
     finally:
         if finalop: finalop()
-        newobj = obj
-        obj = holdobj
-        op = holdop
-        do_op(newobj)
+        if profiler: profiler.blocks.pop()
+        newobj = _current()
+        c.obj, c.op, c.pending, c.pendingop = hold
+        if instances is None:
+            do_op(newobj)
+        else:
+            _add_instances(newobj, instances)
+
+def _add_instances(shape, instances):
+    """Add a copy of `shape` placed by each transform in `instances` to the
+current operation
+
+A union or difference takes the copies as separate operands of its one
+boolean; otherwise they are fused into a single item first, so that the
+pattern counts as one item, e.g. as the first item of a difference."""
+    copies = [_make('transform', _build_transform, shape, t)
+        for t in instances]
+    c = current_context()
+    n = next(c.op)
+    if n is _fuse or n is _cut:
+        for copy in copies:
+            n(c.obj, copy)
+    elif len(copies) == 1:
+        n(c.obj, copies[0])
+    else:
+        n(c.obj, _make('fuse', _build_boolean, 'fuse', copies[0],
+            tuple(copies[1:])))
 
 @contextlib.contextmanager
 def TemporaryDirectory(*args):
@@ -202,14 +774,858 @@ def TemporaryDirectory(*args):
     finally:
         shutil.rmtree(d)
 
+### Shape cache
+
+cache = None
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'poc')
+
+class ShapeCache(object):
+    """An on-disk store of shapes, keyed by a hash of how they were made
+
+Each entry is a binary BRep file (or the compiled code of a .poc file,
+see `execpoc`).  When the total size of the entries
+exceeds `limit` bytes, the least recently used ones are removed."""
+    def __init__(self, directory=None, limit=1<<30):
+        self.directory = directory or default_cache_dir()
+        self.limit = limit
+        self.size = None
+        self.hits = self.misses = 0
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            if not os.path.isdir(self.directory): raise
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".brep")
+
+    def get(self, key):
+        """Return the shape stored under `key`, or None"""
+        path = self._path(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            self.misses += 1
+            return None
+        shape = OCC.TopoDS.TopoDS_Shape()
+        if not OCC.BinTools.bintools.Read(shape, path) or shape.IsNull():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return shape
+
+    def put(self, key, shape):
+        """Store `shape` under `key`, evicting old entries if needed"""
+        if shape.IsNull(): return
+        path = self._path(key)
+        tmp = "%s.%d.%d.tmp" % (path, os.getpid(),
+            threading.current_thread().ident)
+        OCC.BinTools.bintools.Write(shape, tmp)
+        os.rename(tmp, path)
+        if self.size is None:
+            self.trim()
+        else:
+            self.size += os.path.getsize(path)
+            if self.size > self.limit: self.trim()
+
+    def trim(self):
+        """Remove least recently used entries until within the size limit"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith((".brep", ".pyc")): continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        self.size = sum(e[1] for e in entries)
+        entries.sort()
+        for mtime, size, path in entries:
+            if self.size <= self.limit: break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.size -= size
+
+def _shape_to_bytes(shape):
+    with TemporaryDirectory() as d:
+        fn = os.path.join(d, "shape.brep")
+        OCC.BinTools.bintools.Write(shape, fn)
+        with open(fn, "rb") as f:
+            return f.read()
+
+def _shape_from_bytes(data):
+    with TemporaryDirectory() as d:
+        fn = os.path.join(d, "shape.brep")
+        with open(fn, "wb") as f:
+            f.write(data)
+        shape = OCC.TopoDS.TopoDS_Shape()
+        OCC.BinTools.bintools.Read(shape, fn)
+    return _downcast(shape)
+
+def _downcast(shape):
+    """Return `shape` as the TopoDS subclass matching its type"""
+    if shape.IsNull(): return shape
+    t = shape.ShapeType()
+    topods = OCC.TopoDS.topods
+    for topabs, fn in (
+            (OCC.TopAbs.TopAbs_VERTEX, topods.Vertex),
+            (OCC.TopAbs.TopAbs_EDGE, topods.Edge),
+            (OCC.TopAbs.TopAbs_WIRE, topods.Wire),
+            (OCC.TopAbs.TopAbs_FACE, topods.Face),
+            (OCC.TopAbs.TopAbs_SHELL, topods.Shell),
+            (OCC.TopAbs.TopAbs_SOLID, topods.Solid),
+            (OCC.TopAbs.TopAbs_COMPSOLID, topods.CompSolid),
+            (OCC.TopAbs.TopAbs_COMPOUND, topods.Compound)):
+        if t == topabs: return fn(shape)
+    return shape
+
+def _digest(shape):
+    """Return a hash identifying `shape`
+
+Shapes made by `_make` are identified by the key they were made under;
+anything else is identified by its serialized contents."""
+    if shape.IsNull(): return 'null'
+    digests = current_context().digests
+    entry = digests.get(id(shape))
+    if entry is None:
+        digest = hashlib.sha1(_shape_to_bytes(shape)).hexdigest()
+        entry = digests[id(shape)] = (shape, digest)
+    return entry[1]
+
+def _remember(shape, key):
+    current_context().digests[id(shape)] = (shape, key)
+
+def _normalize(x):
+    if isinstance(x, (list, tuple)):
+        return tuple(_normalize(i) for i in x)
+    if x is None or isinstance(x, (bool, float, six.integer_types,
+            six.string_types)):
+        return x
+    if isinstance(x, (OCC.gp.gp_Pnt, OCC.gp.gp_Vec, OCC.gp.gp_Dir)):
+        return (x.X(), x.Y(), x.Z())
+    if isinstance(x, OCC.gp.gp_Trsf):
+        return tuple(x.Value(i, j) for i in range(1, 4) for j in range(1, 5))
+    if isinstance(x, OCC.TopoDS.TopoDS_Shape):
+        return ('shape', _digest(x))
+    if isinstance(x, Node) and x.key:
+        return ('shape', x.key)
+    raise TypeError("cannot normalize %r" % (x,))
+
+# Part of every cache key.  Increase it when a _build_ function changes
+# what it makes, so that shapes made by the old code are not used.
+cache_version = 1
+_salt = None
+
+def _key(name, args):
+    """Return the cache key for operation `name` applied to `args`,
+or None if the arguments cannot be hashed (e.g., they include a function)
+
+The key also depends on `cache_version` and the version of pythonocc."""
+    global _salt
+    try:
+        args = _normalize(args)
+    except TypeError:
+        return None
+    if _salt is None:
+        _salt = (cache_version, getattr(OCC, 'VERSION', None))
+    return hashlib.sha1(repr((_salt, name, args)).encode('utf-8')).hexdigest()
+
+# Operations which are quicker to redo than to load from the cache
+_uncached = set(['transform', 'Text'])
+
+def _make(name, build, *args):
+    """Make a shape by calling build(*args)
+
+In deferred mode, this returns a `Node` to be evaluated later."""
+    if deferred:
+        return Node(name, build, args)
+    return _compute(name, build, args)
+
+def _compute(name, build, args, origin=None):
+    _progress(name)
+    if profiler:
+        build = functools.partial(profiler.measure, name,
+            origin or profiler.origin(), build)
+    key = cache and _key(name, args)
+    if not key:
+        return build(*args)
+    if name in _uncached:
+        shape = build(*args)
+    else:
+        shape = cache.get(key)
+        if shape is None:
+            shape = build(*args)
+            cache.put(key, shape)
+    _remember(shape, key)
+    return shape
+
+### Profiling
+
+profiler = None
+
+def _caller():
+    """Return the file and line outside poctools which led to this call"""
+    f = sys._getframe(1)
+    while f.f_back and f.f_globals.get('__name__') in (__name__, 'contextlib'):
+        f = f.f_back
+    return (f.f_code.co_filename, f.f_lineno)
+
+def _timed(kind, fn, *args):
+    if profiler:
+        return profiler.measure(kind, profiler.origin(), fn, *args)
+    return fn(*args)
+
+def _peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _count(shape, topologyType):
+    m = OCC.TopTools.TopTools_IndexedMapOfShape()
+    OCC.TopExp.topexp.MapShapes(shape, topologyType, m)
+    return m.Extent()
+
+class Profiler(object):
+    """Records the time taken by each modeling operation
+
+Each record is attributed to the line of the .poc file which requested
+the operation, and to the lines of the `with` blocks enclosing it."""
+    # Which phase each kind of record counts towards; other operations
+    # count towards 'modeling'
+    phase_of = {
+        'fuse': 'boolean', 'cut': 'boolean', 'common': 'boolean',
+        'mesh': 'tessellation',
+        'stl': 'write', 'ply': 'write', 'obj': 'write', '3mf': 'write',
+        'brep': 'write',
+    }
+
+    def __init__(self):
+        self.records = []
+        self.blocks = []
+        self.phases = collections.Counter()
+        self.started = timeit.default_timer()
+        # Time spent in measured operations, not counting those nested
+        # inside another, e.g. the mesh made while writing an STL
+        self.measured = 0
+        self.depth = 0
+
+    def origin(self):
+        """Return the enclosing blocks and the calling line, outermost first"""
+        return tuple(self.blocks) + (_caller(),)
+
+    def measure(self, kind, origin, fn, *args):
+        """Call fn(*args) and record how long it took"""
+        t0 = timeit.default_timer()
+        self.depth += 1
+        try:
+            result = fn(*args)
+        finally:
+            self.depth -= 1
+        seconds = timeit.default_timer() - t0
+        if not self.depth: self.measured += seconds
+        self.record(kind, origin, seconds, result)
+        return result
+
+    def record(self, kind, origin, seconds, shape=None):
+        r = {
+            'kind': kind,
+            'file': origin[-1][0],
+            'line': origin[-1][1],
+            'stack': [list(o) for o in origin],
+            'seconds': seconds,
+        }
+        if isinstance(shape, OCC.TopoDS.TopoDS_Shape) and not shape.IsNull():
+            r['faces'] = _count(shape, OCC.TopAbs.TopAbs_FACE)
+            r['edges'] = _count(shape, OCC.TopAbs.TopAbs_EDGE)
+        self.records.append(r)
+
+    def report(self):
+        phases = collections.Counter(self.phases)
+        for r in self.records:
+            phases[self.phase_of.get(r['kind'], 'modeling')] += r['seconds']
+        return {
+            'total': timeit.default_timer() - self.started,
+            'peak_rss_kb': _peak_rss(),
+            'phases': dict(phases),
+            'stats': dict(current_context().stats),
+            'records': self.records,
+        }
+
+    def collapsed(self):
+        """Return the records as collapsed stacks, as used by flamegraph.pl"""
+        totals = collections.OrderedDict()
+        for r in self.records:
+            frames = ["%s:%d" % (os.path.basename(f), l) for f, l in r['stack']]
+            frames.append(r['kind'])
+            k = ";".join(frames)
+            totals[k] = totals.get(k, 0) + r['seconds']
+        return "".join("%s %d\n" % (k, round(v * 1e6))
+            for k, v in totals.items())
+
+    def write(self, prefix):
+        """Write prefix.json and prefix.folded"""
+        with open(prefix + ".json", "w") as f:
+            json.dump(self.report(), f, indent=1)
+        with open(prefix + ".folded", "w") as f:
+            f.write(self.collapsed())
+
+### Deferred evaluation
+
+deferred = False
+
+class Node(object):
+    """A shape which has not been computed yet
+
+It records the operation `name`, the function which builds it and the
+arguments to that function, which may include other nodes."""
+    __slots__ = ('name', 'build', 'args', 'key', 'shape', 'origin')
+
+    def __init__(self, name, build, args):
+        self.name = name
+        self.build = build
+        self.args = args
+        self.key = _key(name, args)
+        self.shape = None
+        self.origin = profiler and profiler.origin()
+
+    def __repr__(self):
+        return "<Node %s %s>" % (self.name, self.key)
+
+    def __getstate__(self):
+        return (self.name, self.build, _portable(self.args), self.key)
+
+    def __setstate__(self, state):
+        self.name, self.build, args, self.key = state
+        self.args = _restore(args)
+        self.shape = None
+        self.origin = None
+
+class _Portable(object):
+    """A picklable stand-in for a shape or transformation"""
+    def __init__(self, kind, data):
+        self.kind = kind
+        self.data = data
+
+    def restore(self):
+        if self.kind == 'shape':
+            return _shape_from_bytes(self.data)
+        return Matrix(*self.data)
+
+def _portable(x):
+    if isinstance(x, (list, tuple)):
+        return type(x)(_portable(i) for i in x)
+    if isinstance(x, OCC.TopoDS.TopoDS_Shape):
+        return _Portable('shape', _shape_to_bytes(x))
+    if isinstance(x, OCC.gp.gp_Trsf):
+        return _Portable('trsf', _normalize(x))
+    if isinstance(x, (OCC.gp.gp_Pnt, OCC.gp.gp_Vec, OCC.gp.gp_Dir)):
+        return _normalize(x)
+    return x
+
+def _restore(x):
+    if isinstance(x, (list, tuple)):
+        return type(x)(_restore(i) for i in x)
+    if isinstance(x, _Portable):
+        return x.restore()
+    return x
+
+# If true, shapes evaluated in one run are kept for the next, as long as
+# the next run still uses them
+retain = False
+
+def _evaluate(x):
+    """Compute the shape of `x` and of any nodes it depends on
+
+Nodes with the same key are only computed once."""
+    if isinstance(x, (list, tuple)):
+        return type(x)(_evaluate(i) for i in x)
+    if not isinstance(x, Node):
+        return x
+    c = current_context()
+    if x.shape is None:
+        shape = x.key and c.evaluated.get(x.key)
+        if shape is None:
+            shape = _evaluate_node(x)
+            if x.key: c.evaluated[x.key] = shape
+        x.shape = shape
+        # Without a cache, _compute does not record the key of the shape,
+        # and nodes made from it would have to serialize it for `_digest`
+        if x.key and id(shape) not in c.digests: _remember(shape, x.key)
+    if x.key: c.used.add(x.key)
+    return x.shape
+
+def _evaluate_node(node):
+    args = node.args
+    if node.build is _build_boolean and node.name != 'common':
+        operands = _operands(*args)
+        if len(operands) == 1:
+            return _evaluate(operands[0])
+        if jobs > 1 and not _in_worker and not profiler:
+            _evaluate_parallel(operands)
+        args = (node.name, operands[0], tuple(operands[1:]))
+    return _compute(node.name, node.build, _evaluate(args), node.origin)
+
+### Parallel evaluation
+
+jobs = 1
+_in_worker = False
+_pool = None
+
+def _worker_init():
+    global _in_worker, _progress_conn
+    _in_worker = True
+    _progress_conn = None
+
+def _evaluate_remote(node):
+    c = current_context()
+    before = c.stats.copy()
+    shape = _evaluate(node)
+    data = _shape_to_bytes(shape)
+    entry = c.digests.get(id(shape))
+    digest = entry[1] if entry else hashlib.sha1(data).hexdigest()
+    return data, digest, c.stats - before
+
+def _evaluate_parallel(operands):
+    """Evaluate the independent subtrees among `operands` in worker processes
+
+Only operands which are themselves made from other nodes are sent to
+a worker; primitives are cheaper to build than to transfer.  The
+results are placed in the same nodes they came from, so the outcome
+does not depend on the number of workers."""
+    global _pool
+    c = current_context()
+    subtrees = []
+    for o in operands:
+        if (isinstance(o, Node) and o.shape is None
+                and not (o.key and o.key in c.evaluated)
+                and any(isinstance(a, Node) for a in _flatargs(o.args))
+                and o not in subtrees):
+            subtrees.append(o)
+    if len(subtrees) < 2: return
+    if _pool is None:
+        import multiprocessing
+        _pool = multiprocessing.Pool(jobs, _worker_init)
+    try:
+        results = _pool.map(_evaluate_remote, subtrees, 1)
+    except (TypeError, pickle.PicklingError):
+        return  # evaluate them here instead
+    for node, (data, digest, counts) in zip(subtrees, results):
+        c.stats.update(counts)
+        shape = _shape_from_bytes(data)
+        _remember(shape, digest)
+        node.shape = shape
+        if node.key: c.evaluated[node.key] = shape
+
+def _flatargs(args):
+    for a in args:
+        if isinstance(a, (list, tuple)):
+            for b in _flatargs(a): yield b
+        else:
+            yield a
+
+### Batch builds
+
+def _dependencies(filename, ns, imported=()):
+    """Return the source files of `filename` and of the modules it used:
+those named in `imported` or referred to by its namespace, and the
+modules that those refer to in turn
+
+Installed packages are listed, but not the modules they refer to, and
+the standard library is left out."""
+    stdlib = os.path.dirname(os.path.abspath(os.__file__)) + os.sep
+    result = set([os.path.abspath(filename)])
+    todo = [sys.modules.get(n) for n in imported] + list(ns.values())
+    seen = set()
+    while todo:
+        m = todo.pop()
+        if not isinstance(m, types.ModuleType):
+            m = getattr(m, '__module__', None)
+            if not isinstance(m, six.string_types): continue
+            m = sys.modules.get(m)
+            if m is None: continue
+        if id(m) in seen: continue
+        seen.add(id(m))
+        f = getattr(m, '__file__', None)
+        if not f: continue
+        if f.endswith(('.pyc', '.pyo')): f = f[:-1]
+        f = os.path.abspath(f)
+        installed = (os.sep + 'site-packages' in f
+            or os.sep + 'dist-packages' in f)
+        if f.startswith(stdlib) and not installed: continue
+        if os.path.exists(f): result.add(f)
+        # Follow the modules which this one uses; this finds them whether
+        # or not an earlier run in the same process loaded them already
+        if not installed: todo.extend(list(vars(m).values()))
+    return sorted(result)
+
+def _depfile(filename):
+    return os.path.splitext(filename)[0] + ".d"
+
+def _build_mode():
+    """Describe the settings which change what a build writes"""
+    if draft: return "draft deflection=%r" % draft_deflection
+    return "full deflection=%r" % relative_deflection
+
+def write_depfile(path, target, depends, mode=None):
+    """Write a make-style dependency file
+
+If `mode` is given, it is recorded in a comment for `up_to_date`."""
+    def quote(f): return f.replace(" ", "\\ ")
+    with open(path + ".tmp", "w") as f:
+        if mode: f.write("# mode: %s\n" % mode)
+        f.write("%s: %s\n" % (quote(target),
+            " \\\n  ".join(quote(d) for d in depends)))
+    os.rename(path + ".tmp", path)
+
+def up_to_date(path, mode=None):
+    """Return True if the target named in the dependency file `path` is
+newer than everything it depends on, and if `mode` is given, was built
+in that mode"""
+    try:
+        with open(path) as f:
+            text = f.read()
+        recorded = None
+        if text.startswith("# mode: "):
+            line, text = text.split("\n", 1)
+            recorded = line[len("# mode: "):]
+        if mode is not None and recorded != mode:
+            return False
+        text = text.replace("\\\n", " ")
+        target, depends = text.split(": ", 1)
+        depends = [d.replace("\0", " ") for d in
+            depends.replace("\\ ", "\0").split()]
+        mtime = os.stat(target.replace("\\ ", " ")).st_mtime
+        return all(os.stat(d).st_mtime <= mtime for d in depends)
+    except (OSError, IOError, ValueError):
+        return False
+
+def build(filename, outfile=None, force=False):
+    """Execute the .poc file `filename` and write its output, unless the
+output is newer than the file and every module it used when last built
+
+The dependencies are recorded in a make-style file next to `filename`.
+Returns a dict with the 'status' ('built', 'up to date' or 'failed'),
+the 'output' file, the 'seconds' taken, the number of shape 'cache hits'
+and, for a failure, the 'error'."""
+    depfile = _depfile(filename)
+    if not force and up_to_date(depfile, _build_mode()):
+        return {'filename': filename, 'output': outfile,
+            'status': 'up to date', 'seconds': 0, 'cache hits': 0}
+    return _execute([filename],
+        outfile or os.path.splitext(filename)[0] + ".stl", depfile)
+
+def _execute(args, outfile, depfile=None, **kw):
+    t0 = timeit.default_timer()
+    hits = cache.hits if cache else 0
+    result = {'filename': args[0], 'output': outfile}
+    try:
+        ns = execpoc(args, __output__=outfile, **kw)
+        output(ns['__output__'])
+        if depfile:
+            write_depfile(depfile, ns['__output__'], ns['__depends__'],
+                _build_mode())
+        result['output'] = ns['__output__']
+        result['status'] = 'built'
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    result['seconds'] = timeit.default_timer() - t0
+    result['cache hits'] = (cache.hits if cache else 0) - hits
+    return result
+
+def build_many(filenames, jobs=1, force=False):
+    """Build each of `filenames` as by `build`, in `jobs` worker processes
+
+The workers are forked once and each builds many files, so the cost of
+starting Python and loading OCC is paid once per worker.  Yields the
+result of each build as it finishes."""
+    if jobs <= 1:
+        for f in filenames:
+            yield build(f, force=force)
+        return
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs, _worker_init)
+    try:
+        for r in pool.imap_unordered(
+                functools.partial(_build_task, force=force), filenames):
+            yield r
+    finally:
+        pool.terminate()
+
+def _build_task(filename, force):
+    return build(filename, force=force)
+
+def read_table(filename):
+    """Read a table of parameters: a .csv file whose first row names the
+columns, or a .json file holding a list of objects or of lists
+
+Returns a list of rows, each a list of (column name, value) pairs."""
+    if filename.endswith('.json'):
+        with open(filename) as f:
+            data = json.load(f, object_pairs_hook=collections.OrderedDict)
+        return [list(r.items()) if isinstance(r, dict)
+            else [(str(i), v) for i, v in enumerate(r)] for r in data]
+    import csv
+    with (open(filename, 'rb') if six.PY2
+            else io.open(filename, newline='')) as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        return [list(zip(header, r)) for r in reader if r]
+
+def sweep(filename, rows, pattern=None, args=(), jobs=1):
+    """Build the .poc file `filename` once for each of `rows`, as returned
+by `read_table`
+
+The values of each row follow `args` in sys.argv, and the file can also
+find them by column name in `__params__`.  Each output is written to
+`pattern` formatted with the row's values by position and by column
+name, and with its `index` (default: input-{index}.stl).
+
+The variants are built in deferred mode in `jobs` worker processes.
+Each worker is given runs of consecutive rows and keeps the shapes from
+one variant for the next, so parts which do not depend on the varied
+parameters are not made again; the shape cache shares them between
+workers.  Yields the result of each build as by `build`, with the
+row's 'index'."""
+    if pattern is None:
+        pattern = os.path.splitext(filename)[0] + "-{index}.stl"
+    tasks = []
+    for i, row in enumerate(rows):
+        values = [v for k, v in row]
+        named = dict(row)
+        named.setdefault('index', i)
+        outfile = pattern.format(*values, **named)
+        tasks.append((i, list(args) + [str(v) for v in values],
+            collections.OrderedDict(row), outfile))
+    chunk = max(1, len(tasks) // (jobs * 4))
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs, _sweep_init)
+    try:
+        for r in pool.imap_unordered(
+                functools.partial(_sweep_task, filename), tasks, chunk):
+            yield r
+    finally:
+        pool.terminate()
+
+def _sweep_init():
+    global deferred, retain
+    _worker_init()
+    deferred = retain = True
+
+def _sweep_task(filename, task):
+    i, args, params, outfile = task
+    result = _execute([filename] + args, outfile, __params__=params)
+    result['index'] = i
+    return result
+
+### Worker processes
+
+class Worker(object):
+    """A long-lived process which evaluates .poc files
+
+OCC stays loaded in the worker, and it evaluates in deferred mode while
+keeping the shapes from its previous run, so re-running a file after an
+edit only computes the parts whose source or inputs changed.
+
+The worker is forked from the current process, so settings such as
+`cache` are inherited from it.  After each successful job, `depends`
+lists the files it used, as recorded by `execpoc`."""
+    def __init__(self):
+        self.depends = []
+        self.stage = None
+        self._result = None
+        import multiprocessing
+        self.cancelled = multiprocessing.Event()
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_worker_main,
+            args=(child, self.cancelled))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+
+    def submit(self, args, mesh=False, draft=False, **kw):
+        """Start executing the .poc file args[0] and writing its output
+
+If `mesh` is true, the model is instead meshed as by `tessellate` and
+written to a temporary binary STL file, for `read_stl`; the caller
+removes it.  If `draft` is true, the file is executed in draft mode.
+Keyword arguments are added to the file's namespace, as for `execpoc`.
+While the job runs, `stage` names the step it is on."""
+        self.cancelled.clear()
+        self.stage = 'starting'
+        self.conn.send((args, mesh, draft, kw))
+
+    def cancel(self):
+        """Ask the submitted job to stop at the next operation
+
+Its result is then ('cancelled', None).  Shapes it already made are
+kept for the next job."""
+        self.cancelled.set()
+
+    def _receive(self):
+        message = self.conn.recv()
+        if message[0] == 'stage':
+            self.stage = message[1]
+            return None
+        status, value, depends = message
+        if depends is not None: self.depends = depends
+        return status, value
+
+    def ready(self):
+        """Return True if the result of the submitted job is available"""
+        while self._result is None and self.conn.poll():
+            self._result = self._receive()
+        return self._result is not None
+
+    def result(self, timeout=None):
+        """Wait for the submitted job and return ('ok', output filename),
+('ok', STL filename) for a mesh job, ('error', traceback text),
+or ('cancelled', None)
+
+If `timeout` seconds pass first, return None instead."""
+        if timeout is not None:
+            deadline = timeit.default_timer() + timeout
+        while self._result is None:
+            if timeout is not None and not self.conn.poll(
+                    max(0, deadline - timeit.default_timer())):
+                return None
+            self._result = self._receive()
+        result, self._result = self._result, None
+        self.stage = None
+        return result
+
+    def run(self, args, mesh=False, draft=False, **kw):
+        self.submit(args, mesh, draft, **kw)
+        return self.result()
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (IOError, OSError):
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+
+class Cancelled(BaseException):
+    """Raised in a worker when its job is cancelled
+
+Like KeyboardInterrupt, this is not caught by ``except Exception``."""
+
+# In a Worker, the connection to report progress over and the event which
+# cancels the current job
+_progress_conn = None
+_cancel = None
+
+def _progress(stage):
+    """Report the step a worker's job is on, or stop it if it was cancelled"""
+    if _cancel is None: return
+    if _cancel.is_set(): raise Cancelled()
+    if _progress_conn: _progress_conn.send(('stage', stage))
+
+def _worker_main(conn, cancel):
+    global deferred, retain, _progress_conn, _cancel
+    deferred = retain = True
+    _progress_conn = conn
+    _cancel = cancel
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None: break
+        conn.send(_run_job(*job))
+
+def _run_job(args, mesh, draft_mode, kw):
+    global draft
+    draft = draft_mode
+    try:
+        _progress('executing')
+        ns = execpoc(args, **kw)
+        if mesh:
+            _progress('meshing')
+            # Only the filename goes through the pipe, not the mesh
+            fd, filename = tempfile.mkstemp(".stl", "pocview-")
+            os.close(fd)
+            try:
+                occ_to_stl(Object(), filename)
+            except BaseException:
+                os.remove(filename)
+                raise
+            return ('ok', filename, ns['__depends__'])
+        _progress('writing')
+        output(ns['__output__'])
+        return ('ok', ns['__output__'], ns['__depends__'])
+    except Cancelled:
+        # the next run may still need what this one did not reach
+        c = current_context()
+        c.used.update(c.evaluated)
+        return ('cancelled', None, None)
+    except Exception:
+        return ('error', traceback.format_exc(), None)
+
+def _pending_node(x, kind):
+    return (isinstance(x, Node) and x.name == kind and x.shape is None
+        and not (x.key and x.key in current_context().evaluated))
+
+def _empty(x):
+    return isinstance(x, OCC.TopoDS.TopoDS_Shape) and x.IsNull()
+
+def _operands(kind, shape, tools):
+    """Rewrite a fuse or cut before evaluating it
+
+Nested unions are flattened, as are nested cuts (a - b - c becomes
+a - (b, c)) and unions used as cut tools; empty operands are dropped;
+and the tools of a cut are sorted, so that the same set of tools
+gives the same result regardless of their order in the source.
+
+Returns the list of operands, base shape first."""
+    def flatten(x, result):
+        if _pending_node(x, 'fuse'):
+            flatten(x.args[1], result)
+            for t in x.args[2]: flatten(t, result)
+        elif not _empty(x):
+            result.append(x)
+        return result
+
+    if kind == 'fuse':
+        operands = flatten(shape, [])
+        for t in tools: flatten(t, operands)
+        return operands or [OCC.TopoDS.TopoDS_Shape()]
+
+    tools = list(tools)
+    while _pending_node(shape, 'cut'):
+        tools = list(shape.args[2]) + tools
+        shape = shape.args[1]
+    if _empty(shape):
+        return [shape]
+    flat = []
+    for t in tools: flatten(t, flat)
+    if all(isinstance(t, Node) and t.key for t in flat):
+        flat.sort(key=lambda t: t.key)
+    return [shape] + flat
+
 ### Primitives
 
 def Box(p1, p2):
     """Create a box primitive"""
-    do_op(OCC.BRepPrimAPI.BRepPrimAPI_MakeBox(_pt(p1), _pt(p2)).Shape())
+    do_op(_make('Box', _build_box, p1, p2))
+
+def _build_box(p1, p2):
+    return OCC.BRepPrimAPI.BRepPrimAPI_MakeBox(_pt(p1), _pt(p2)).Shape()
 
 def Cylinder(p1, p2, radius):
     """Create a cylinder primitive"""
+    do_op(_make('Cylinder', _build_cylinder, p1, p2, radius))
+
+def _build_cylinder(p1, p2, radius):
     p1 = _pt(p1)
     p2 = _pt(p2)
     dx = p2.X() - p1.X()
@@ -217,10 +1633,13 @@ def Cylinder(p1, p2, radius):
     dz = p2.Z() - p1.Z()
     length = (dx*dx + dy*dy + dz*dz) ** .5
     ax = OCC.gp.gp_Ax2(p1, OCC.gp.gp_Dir(dx/length, dy/length, dz/length))
-    do_op(OCC.BRepPrimAPI.BRepPrimAPI_MakeCylinder(ax, radius, length).Shape())
+    return OCC.BRepPrimAPI.BRepPrimAPI_MakeCylinder(ax, radius, length).Shape()
 
 def Cone(p1, p2, radius1, radius2):
     """Create a cone primitive"""
+    do_op(_make('Cone', _build_cone, p1, p2, radius1, radius2))
+
+def _build_cone(p1, p2, radius1, radius2):
     p1 = _pt(p1)
     p2 = _pt(p2)
     dx = p2.X() - p1.X()
@@ -230,36 +1649,132 @@ def Cone(p1, p2, radius1, radius2):
     ax = OCC.gp.gp_Ax2(p1, OCC.gp.gp_Dir(dx/length, dy/length, dz/length))
     builder = OCC.BRepPrimAPI.BRepPrimAPI_MakeCone(
             ax, radius1, radius2, length)
-    shape = builder.Shape()
-    do_op(shape)
+    return builder.Shape()
 
 def Sphere(center, radius):
     """Create a sphere primitive"""
-    do_op(OCC.BRepPrimAPI.BRepPrimAPI_MakeSphere(_pt(center), radius).Shape())
+    do_op(_make('Sphere', _build_sphere, center, radius))
+
+def _build_sphere(center, radius):
+    return OCC.BRepPrimAPI.BRepPrimAPI_MakeSphere(_pt(center), radius).Shape()
 
 def Text(height, depth, text, fontpath=None):
-    """TODO Create extruded text
+    """Create extruded text
+
+The text starts at the origin and runs along the X axis in a font of
+size `height`, and is extruded `depth` along the Z axis.  Each newline
+starts a new line below.  If `fontpath` is None, `default_font` is used.
+
+Each glyph is made once for each font, height and depth and placed
+wherever it occurs, and the result is a compound of the placed glyphs,
+so repeated characters, as in serial numbers, are cheap."""
+    fontpath = fontpath or default_font()
+    # Replacing the font file at the same path makes new glyphs
+    st = os.stat(fontpath)
+    font = (fontpath, st.st_mtime, st.st_size)
+    if isinstance(text, bytes): text = text.decode('utf-8')
+    metrics = _font(font, height)
+    glyphs = []
+    x = y = 0
+    for c, n in zip(text, text[1:] + u'\0'):
+        if c == u'\n':
+            x = 0
+            y -= metrics.LineSpacing()
+            continue
+        if not c.isspace():
+            glyphs.append(_make('transform', _build_transform,
+                _glyph(font, ord(c), height, depth),
+                _translation(OCC.gp.gp_Vec(x, y, 0))))
+        x += metrics.AdvanceX(ord(c), ord(n))
+    do_op(_make('Text', _build_text, tuple(glyphs)))
+
+def _build_text(glyphs):
+    return _compound([g for g in glyphs if not g.IsNull()])
+
+def _font(font, height):
+    """Return the Font_BRepFont for `font`, a tuple (path, mtime, size)"""
+    fonts = current_context().fonts
+    result = fonts.get((font, height))
+    if result is None:
+        result = fonts[font, height] = OCC.Font.Font_BRepFont(font[0], height)
+    return result
 
-Note that the text may not contain whitespace!
-(this appears to be a bug in occmodel, failing with occmodel.OCCError:
-b'failed to create edges')"""
-    return Box((0,0,0), (1,1,1))
+def _glyph(font, char, height, depth):
+    """Return the extruded glyph for the character code `char`
+
+Glyphs, and the fonts they are made with, are kept in memory by the
+current `Context`, as font objects must not be shared between threads.
+Like other shapes, glyphs are also kept in the shape cache, under a key
+which includes the modification time and size of the font file."""
+    key = (font, char, height, depth)
+    glyphs = current_context().glyphs
+    glyph = glyphs.get(key)
+    if glyph is None:
+        glyph = glyphs[key] = _make('Glyph', _build_glyph, *key)
+    return glyph
+
+def _build_glyph(font, char, height, depth):
+    shape = _font(font, height).RenderGlyph(char)
+    if shape.IsNull(): return shape
+    return OCC.BRepPrimAPI.BRepPrimAPI_MakePrism(shape,
+        OCC.gp.gp_Vec(0, 0, depth)).Shape()
+
+# Fonts which `default_font` looks for, in order of preference, and the
+# directories it looks in
+default_fonts = ['DejaVuSans.ttf', 'LiberationSans-Regular.ttf',
+    'FreeSans.ttf', 'Arial.ttf', 'arial.ttf', 'Helvetica.ttc']
+font_dirs = ['~/.fonts', '~/.local/share/fonts', '/usr/local/share/fonts',
+    '/usr/share/fonts', '~/Library/Fonts', '/Library/Fonts',
+    '/System/Library/Fonts',
+    os.path.join(os.environ.get('WINDIR', 'C:\\Windows'), 'Fonts')]
+
+_default_font = None
+
+def default_font():
+    """Return the font `Text` uses when none is given: $POC_FONT if it is
+set, or else the first of `default_fonts` found under `font_dirs`"""
+    global _default_font
+    if os.environ.get('POC_FONT'): return os.environ['POC_FONT']
+    if _default_font is None:
+        found = {}
+        for d in font_dirs:
+            for root, dirs, files in os.walk(os.path.expanduser(d)):
+                for f in files:
+                    if f in default_fonts:
+                        found.setdefault(f, os.path.join(root, f))
+        for f in default_fonts:
+            if f in found:
+                _default_font = found[f]
+                break
+        else:
+            raise IOError("no font found for Text; "
+                "pass fontpath or set $POC_FONT")
+    return _default_font
 
 def Torus(p1, p2, ringRadius, radius):
     """Create a torus"""
+    do_op(_make('Torus', _build_torus, p1, p2, ringRadius, radius))
+
+def _build_torus(p1, p2, ringRadius, radius):
     axis = _axpt(p1, p2)
     builder = OCC.BRepPrimAPI.BRepPrimAPI_MakeTorus(axis, ringRadius, radius)
-    do_op(builder.Shape())
+    return builder.Shape()
 
 def Extrude(obj, p1, p2):
     """Create a solid by extruding edge, wire, or face from p1 to p2"""
+    do_op(_make('Extrude', _build_extrude, obj, p1, p2))
+
+def _build_extrude(obj, p1, p2):
     p1 = _pt(p1)
     p2 = _pt(p2)
     direction = OCC.gp.gp_Vec(p1, p2)
-    do_op(OCC.BRepPrimAPI.BRepPrimAPI_MakePrism(obj, direction).Shape())
+    return OCC.BRepPrimAPI.BRepPrimAPI_MakePrism(obj, direction).Shape()
 
 def Revolve(face, p1, p2, angle):
     """Create a solid by revolving the face around the given axis"""
+    do_op(_make('Revolve', _build_revolve, face, p1, p2, angle))
+
+def _build_revolve(face, p1, p2, angle):
     p1 = _pt(p1)
     p2 = _pt(p2)
     dx = p2.X() - p1.X()
@@ -267,10 +1782,14 @@ def Revolve(face, p1, p2, angle):
     dz = p2.Z() - p1.Z()
     axis = OCC.gp.gp_Ax1(p1, _dir((dx, dy, dz)))
     angle = math.radians(angle)
-    do_op(OCC.BRepPrimAPI.BRepPrimAPI_MakeRevol(face, axis, angle, False).Shape())
+    return OCC.BRepPrimAPI.BRepPrimAPI_MakeRevol(
+            face, axis, angle, False).Shape()
 
 def Loft(profiles, ruled=True, tolerance=1e-6):
     """Create a solid by lofting through a sequence of wires or closed edges"""
+    do_op(_make('Loft', _build_loft, tuple(profiles), ruled, tolerance))
+
+def _build_loft(profiles, ruled, tolerance):
     builder = OCC.BRepOffsetAPI.BRepOffsetAPI_ThruSections(True, ruled,
                 tolerance)
     for i in profiles:
@@ -280,15 +1799,18 @@ def Loft(profiles, ruled=True, tolerance=1e-6):
             builder.AddVertex(i)
         else:
             builder.AddWire(Wire.createWire(i))
-    do_op(builder.Shape())
+    return builder.Shape()
 
 def Pipe(face, path):
+    do_op(_make('Pipe', _build_pipe, face, path))
+
+def _build_pipe(face, path):
     if isinstance(path, OCC.TopoDS.TopoDS_Edge):
         wire = Wire.createWire((path,))
     else:
         wire = path
     builder = OCC.BRepOffsetAPI.BRepOffsetAPI_MakePipe(wire, face)
-    do_op(builder.Shape())
+    return builder.Shape()
 
 ### Group operations
 
@@ -334,6 +1856,63 @@ def Transformed(mat):
     """Perform a transformation."""
     return Op(Transform, mat)
 
+def LinearPattern(count, delta):
+    """Repeat the contents `count` times in a row, each copy displaced
+by `delta` from the one before
+
+The contents are built once.  The copies are placed instances which
+share its geometry, and all of them are added to the surrounding group
+operation at once, e.g., to be cut from a plate in one operation.  That
+operation makes new faces, so each copy is still meshed separately.
+Where the pattern is the first item of its group, or in an
+`Intersection`, the copies are first fused into one item."""
+    if count < 1:
+        raise ValueError("LinearPattern needs a count of at least 1")
+    delta = _vec(delta)
+    return withhelper(op1(_fuse), instances=[
+        _translation(delta.Multiplied(i)) for i in range(count)])
+
+def PolarPattern(count, axis=(0,0,1), center=(0,0,0), angle=360):
+    """Repeat the contents `count` times around an axis
+
+The copies are spread evenly over `angle` degrees; if that is a whole
+turn, the last copy is one step short of the first.  Like
+`LinearPattern`, the contents are built once."""
+    if count < 1:
+        raise ValueError("PolarPattern needs a count of at least 1")
+    if abs(angle) >= 360 or count < 2:
+        step = float(angle) / count
+    else:
+        step = float(angle) / (count - 1)
+    a = OCC.gp.gp_Ax1(_pt(center), _dir(axis))
+    instances = []
+    for i in range(count):
+        t = OCC.gp.gp_Trsf()
+        t.SetRotation(a, math.radians(i * step))
+        instances.append(t)
+    return withhelper(op1(_fuse), instances=instances)
+
+def GridPattern(nx, ny, dx, dy):
+    """Repeat the contents in a grid of `nx` by `ny` copies
+
+`dx` and `dy` are the displacements between neighbouring copies in
+each direction: vectors, or numbers for spacings along X and Y.  Like
+`LinearPattern`, the contents are built once."""
+    if nx < 1 or ny < 1:
+        raise ValueError("GridPattern needs at least 1 copy in each direction")
+    if not isinstance(dx, (tuple, list, OCC.gp.gp_Vec)): dx = (dx, 0, 0)
+    if not isinstance(dy, (tuple, list, OCC.gp.gp_Vec)): dy = (0, dy, 0)
+    dx = _vec(dx)
+    dy = _vec(dy)
+    return withhelper(op1(_fuse), instances=[
+        _translation(dx.Multiplied(i).Added(dy.Multiplied(j)))
+        for j in range(ny) for i in range(nx)])
+
+def _translation(delta):
+    t = OCC.gp.gp_Trsf()
+    t.SetTranslation(delta)
+    return t
+
 def Filleted(radius, edges=None):
     """Perform a fillet operation"""
     return Op(Fillet, radius, edges)
@@ -344,9 +1923,22 @@ def Chamfered(distance, edges=None):
 
 ### Postfix operations
 
-def _transform(obj, t):
-    _assign(obj,
-        OCC.BRepBuilderAPI.BRepBuilderAPI_Transform(obj, t, True).Shape())
+def _transform(shape, t):
+    # Fold a transform of a transform which is still deferred into one
+    if (isinstance(shape, Node) and shape.build is _build_transform
+            and shape.shape is None):
+        shape, t = shape.args[0], t.Multiplied(shape.args[1])
+    _assign(None, _make('transform', _build_transform, shape, t))
+
+def _rigid(t):
+    return abs(t.ScaleFactor() - 1) < 1e-12 and not t.IsNegative()
+
+def _build_transform(shape, t):
+    # A rigid motion only changes the location of the shape, which shares
+    # its geometry with the original; anything else needs a copy
+    if _rigid(t):
+        return shape.Moved(OCC.TopLoc.TopLoc_Location(t))
+    return OCC.BRepBuilderAPI.BRepBuilderAPI_Transform(shape, t, True).Shape()
 
 def Rotate(angle, axis, center=(0,0,0)):
     """Rotate the active object"""
@@ -356,13 +1948,13 @@ def Rotate(angle, axis, center=(0,0,0)):
     a.SetDirection(_dir(axis))
     t = OCC.gp.gp_Trsf()
     t.SetRotation(a, angle)
-    _transform(obj, t)
+    _transform(_current(), t)
 
 def Translate(delta):
     """Translate the active object"""
     t = OCC.gp.gp_Trsf()
     t.SetTranslation(_vec(delta))
-    _transform(obj, t)
+    _transform(_current(), t)
 
 def Matrix(*args):
     """Construct a 4x3 matrix from arguments, which may be
@@ -395,7 +1987,7 @@ def Transform(mat):
     """Transform the active object
 
 Note that `geotools.Transform` is imported as `Xform` within poc files."""
-    _transform(obj, mat)
+    _transform(_current(), mat)
 
 def Fillet(radius, edges=None):
     """Fillet the active object
@@ -406,15 +1998,42 @@ If `edges` is callable, it is treated as a predicate which returns
 True for each edge that should be filleted.
 
 Otherwise, `edges` must be a sequence of edges to fillet.
+
+In draft mode, this does nothing.
 """
+    if draft: return
+    shape, edges = _edge_args(edges)
+    _assign(None, _make('Fillet', _build_fillet, shape, radius, edges))
+
+def _edge_args(edges):
+    # Edges are passed to _make by their index in the current item, so
+    # that the cache key does not have to serialize each one
     if callable(edges):
         edges = [e for e in Edges() if edges(e)]
-    elif edges is None:
-        edges = [e for e in Edges()]
-    fillet = OCC.BRepFilletAPI.BRepFilletAPI_MakeFillet(obj)
+    if edges is None:
+        return _current(), None
+    shape = Object()
+    m = _index(shape).ancestors()
+    indices = []
+    for e in edges:
+        i = m.FindIndex(e)
+        if not i:
+            raise ValueError("edge is not part of the current item")
+        indices.append(i)
+    return shape, tuple(indices)
+
+def _edges_from(shape, indices):
+    if indices is None:
+        return visit(shape, OCC.TopAbs.TopAbs_EDGE, OCC.TopoDS.topods.Edge)
+    m = _index(shape).ancestors()
+    return [OCC.TopoDS.topods.Edge(m.FindKey(i)) for i in indices]
+
+def _build_fillet(shape, radius, edges):
+    edges = _edges_from(shape, edges)
+    fillet = OCC.BRepFilletAPI.BRepFilletAPI_MakeFillet(shape)
     for e in edges:
         fillet.Add(radius, e)
-    _assign(obj, fillet.Shape())
+    return fillet.Shape()
 
 def Chamfer(distance, edges=None):
     """Chamfer the active object
@@ -425,21 +2044,23 @@ If `edges` is callable, it is treated as a predicate which returns
 True for each edge that should be filleted.
 
 Otherwise, `edges` must be a sequence of edges to fillet.
+
+In draft mode, this does nothing.
 """
-    if callable(edges):
-        edges = [e for e in Edges() if edges(e)]
-    elif edges is None:
-        edges = [e for e in Edges()]
-    chamfer = OCC.BRepFilletAPI.BRepFilletAPI_MakeChamfer(obj)
-    m = OCC.TopTools.TopTools_IndexedDataMapOfShapeListOfShape();
-    OCC.TopExp.topexp.MapShapesAndAncestors(obj, OCC.TopAbs.TopAbs_EDGE,
-        OCC.TopAbs.TopAbs_FACE, m)
+    if draft: return
+    shape, edges = _edge_args(edges)
+    _assign(None, _make('Chamfer', _build_chamfer, shape, distance, edges))
+
+def _build_chamfer(shape, distance, edges):
+    edges = _edges_from(shape, edges)
+    chamfer = OCC.BRepFilletAPI.BRepFilletAPI_MakeChamfer(shape)
+    m = _index(shape).ancestors()
 
     for e in edges:
         f = m.FindFromKey(e).First()
         f = OCC.TopoDS.topods.Face(f)
         chamfer.Add(distance, e, f)
-    _assign(obj, chamfer.Shape())
+    return chamfer.Shape()
 
 ### Inquiries
 
@@ -453,13 +2074,20 @@ def visit(shape, topologyType, factory):
         yield factory(it)
         explorer.Next()
 
+def _current():
+    _flush()
+    return current_context().obj
+
 def Object():
-    return obj
+    """Return the current item, evaluating it if it was deferred"""
+    c = current_context()
+    c.obj = _evaluate(_current())
+    return c.obj
 
 def CenterOfMass():
     """Return the center of mass box of the current item"""
     prop = OCC.GProp.GProp_GProps()
-    OCC.BRepGProp.brepgprop_VolumeProperties(obj, prop)
+    OCC.BRepGProp.brepgprop_VolumeProperties(Object(), prop)
     return prop.CentreOfMass()
 CentreOfMass = CenterOfMass
 
@@ -467,12 +2095,17 @@ def Bbox(o=None):
     """Return the bounding box of given object or the current item a a 6-tuple
 
 (minx, miny, minz, maxx, maxy, maxz)"""
-    box = OCC.Bnd.Bnd_Box()
-    OCC.BRepBndLib.brepbndlib.Add(o or obj, box)
+    box = _bndbox(o or Object())
     lo = box.CornerMin()
     hi = box.CornerMax()
     return ((lo.X(), lo.Y(), lo.Z(), hi.X(), hi.Y(), hi.Z()))
 
+def _bndbox(shape):
+    box = OCC.Bnd.Bnd_Box()
+    if not shape.IsNull():
+        OCC.BRepBndLib.brepbndlib.Add(shape, box)
+    return box
+
 def Edges():
     """Return the edge iterator of the current item"""
     return visit(Object(), OCC.TopAbs.TopAbs_EDGE, OCC.TopoDS.topods.Edge)
@@ -489,6 +2122,258 @@ def Wires():
     """Return the wire iterator of the current item"""
     return visit(Object(), OCC.TopAbs.TopAbs_WIRE, OCC.TopoDS.topods.Wire)
 
+class TopologyIndex(object):
+    """Properties of the distinct edges and faces of a shape, as NumPy arrays
+
+The query methods return boolean masks over the edges (or faces), which
+can be combined with `&`, `|` and `~` and passed to `select` (or
+`select_faces`) to get a list suitable for `Fillet` or `Chamfer`::
+
+    t = Topology()
+    Fillet(1, t.select(t.parallel_to((0,0,1)),
+                       t.inside_box((-inf,-inf,10), (inf,inf,inf))))
+"""
+    def __init__(self, shape):
+        self.shape = shape
+        self.edges = [OCC.TopoDS.topods.Edge(e)
+            for e in _unique(shape, OCC.TopAbs.TopAbs_EDGE)]
+        self.faces = [OCC.TopoDS.topods.Face(f)
+            for f in _unique(shape, OCC.TopAbs.TopAbs_FACE)]
+        self._edge_arrays = None
+        self._face_arrays = None
+        self._ancestors = None
+        self._convexity = None
+
+    def ancestors(self):
+        """Return the map from each edge to the faces which contain it"""
+        if self._ancestors is None:
+            m = OCC.TopTools.TopTools_IndexedDataMapOfShapeListOfShape()
+            OCC.TopExp.topexp.MapShapesAndAncestors(self.shape,
+                OCC.TopAbs.TopAbs_EDGE, OCC.TopAbs.TopAbs_FACE, m)
+            self._ancestors = m
+        return self._ancestors
+
+    def adjacent_faces(self, edge):
+        """Return the distinct faces which contain `edge`"""
+        result = []
+        it = OCC.TopTools.TopTools_ListIteratorOfListOfShape(
+            self.ancestors().FindFromKey(edge))
+        while it.More():
+            f = it.Value()
+            if not any(f.IsSame(g) for g in result):
+                result.append(OCC.TopoDS.topods.Face(f))
+            it.Next()
+        return result
+
+    def edges_between(self, face1, face2):
+        """Return the edges shared by `face1` and `face2`"""
+        return [e for e in self.edges
+            if len([f for f in self.adjacent_faces(e)
+                if f.IsSame(face1) or f.IsSame(face2)]) == 2]
+
+    def _convexity_data(self):
+        if self._convexity is None:
+            import numpy
+            self._convexity = numpy.array(
+                [_convexity(e, self.adjacent_faces(e)) for e in self.edges])
+        return self._convexity
+
+    def convex(self):
+        """Edges where the faces on either side meet at an outside corner"""
+        return self._convexity_data() > 0
+
+    def concave(self):
+        """Edges where the faces on either side meet at an inside corner"""
+        return self._convexity_data() < 0
+
+    def _edge_data(self):
+        if self._edge_arrays is None:
+            import numpy
+            n = len(self.edges)
+            mid = numpy.zeros((n, 3))
+            direction = numpy.zeros((n, 3))
+            lo = numpy.zeros((n, 3))
+            hi = numpy.zeros((n, 3))
+            length = numpy.zeros(n)
+            kind = numpy.zeros(n, int)
+            radius = numpy.full(n, numpy.nan)
+            p = OCC.gp.gp_Pnt()
+            v = OCC.gp.gp_Vec()
+            for i, e in enumerate(self.edges):
+                c = OCC.BRepAdaptor.BRepAdaptor_Curve(e)
+                c.D1((c.FirstParameter() + c.LastParameter()) / 2, p, v)
+                mid[i] = p.X(), p.Y(), p.Z()
+                if v.Magnitude() > 0:
+                    v.Normalize()
+                    direction[i] = v.X(), v.Y(), v.Z()
+                kind[i] = c.GetType()
+                if kind[i] == OCC.GeomAbs.GeomAbs_Circle:
+                    radius[i] = c.Circle().Radius()
+                # The box is enlarged by the tolerance of the edge; take
+                # that back off, so an edge at z=10 is inside a box from z=10
+                box = _bndbox(e)
+                gap = box.GetGap()
+                c0, c1 = box.CornerMin(), box.CornerMax()
+                lo[i] = c0.X() + gap, c0.Y() + gap, c0.Z() + gap
+                hi[i] = c1.X() - gap, c1.Y() - gap, c1.Z() - gap
+                prop = OCC.GProp.GProp_GProps()
+                OCC.BRepGProp.brepgprop_LinearProperties(e, prop)
+                length[i] = prop.Mass()
+            self._edge_arrays = mid, direction, lo, hi, length, kind, radius
+        return self._edge_arrays
+
+    def _face_data(self):
+        if self._face_arrays is None:
+            import numpy
+            n = len(self.faces)
+            normal = numpy.zeros((n, 3))
+            center = numpy.zeros((n, 3))
+            area = numpy.zeros(n)
+            kind = numpy.zeros(n, int)
+            p = OCC.gp.gp_Pnt()
+            v = OCC.gp.gp_Vec()
+            for i, f in enumerate(self.faces):
+                u0, u1, v0, v1 = OCC.BRepTools.breptools.UVBounds(f)
+                # BRepGProp_Face accounts for the orientation of the face
+                OCC.BRepGProp.BRepGProp_Face(f).Normal(
+                    (u0 + u1) / 2, (v0 + v1) / 2, p, v)
+                if v.Magnitude() > 0:
+                    v.Normalize()
+                    normal[i] = v.X(), v.Y(), v.Z()
+                kind[i] = OCC.BRepAdaptor.BRepAdaptor_Surface(f).GetType()
+                prop = OCC.GProp.GProp_GProps()
+                OCC.BRepGProp.brepgprop_SurfaceProperties(f, prop)
+                area[i] = prop.Mass()
+                c = prop.CentreOfMass()
+                center[i] = c.X(), c.Y(), c.Z()
+            self._face_arrays = normal, center, area, kind
+        return self._face_arrays
+
+    edge_midpoints = property(lambda self: self._edge_data()[0],
+        doc="Midpoint of each edge")
+    edge_directions = property(lambda self: self._edge_data()[1],
+        doc="Unit tangent of each edge at its midpoint")
+    edge_lengths = property(lambda self: self._edge_data()[4],
+        doc="Length of each edge")
+    edge_types = property(lambda self: self._edge_data()[5],
+        doc="Curve type of each edge, a GeomAbs_CurveType value")
+    edge_radii = property(lambda self: self._edge_data()[6],
+        doc="Radius of each circular edge; NaN for other edges")
+    face_normals = property(lambda self: self._face_data()[0],
+        doc="Unit outward normal at the middle of each face")
+    face_centers = property(lambda self: self._face_data()[1],
+        doc="Center of mass of each face")
+    face_areas = property(lambda self: self._face_data()[2],
+        doc="Area of each face")
+    face_types = property(lambda self: self._face_data()[3],
+        doc="Surface type of each face, a GeomAbs_SurfaceType value")
+
+    def inside_box(self, lo, hi, tol=1e-6):
+        """Edges whose bounding box is within the box from `lo` to `hi`"""
+        import numpy
+        elo, ehi = self._edge_data()[2:4]
+        return (numpy.all(elo >= numpy.asarray(lo) - tol, axis=1)
+            & numpy.all(ehi <= numpy.asarray(hi) + tol, axis=1))
+
+    def parallel_to(self, axis, tol=1e-6):
+        """Straight edges parallel to `axis`"""
+        import numpy
+        axis = numpy.asarray(axis, float)
+        axis = axis / numpy.linalg.norm(axis)
+        return ((self.edge_types == OCC.GeomAbs.GeomAbs_Line)
+            & (abs(self.edge_directions.dot(axis)) >= 1 - tol))
+
+    def radius_equals(self, radius, tol=1e-6):
+        """Circular edges with the given radius"""
+        import numpy
+        with numpy.errstate(invalid='ignore'):
+            return abs(self.edge_radii - radius) <= tol
+
+    def facing(self, direction, tol=1e-6):
+        """Faces whose normal points along `direction`"""
+        import numpy
+        direction = numpy.asarray(direction, float)
+        direction = direction / numpy.linalg.norm(direction)
+        return self.face_normals.dot(direction) >= 1 - tol
+
+    def select(self, *masks):
+        """Return the edges for which all of the masks are true"""
+        return _masked(self.edges, masks)
+
+    def select_faces(self, *masks):
+        """Return the faces for which all of the masks are true"""
+        return _masked(self.faces, masks)
+
+def _convexity(edge, faces, tol=1e-9):
+    """Return 1 if the two faces meet at `edge` in a convex corner, -1 if
+concave, and 0 if they are tangent or the edge does not join two faces"""
+    if len(faces) != 2: return 0
+    f1, f2 = faces
+    c = OCC.BRepAdaptor.BRepAdaptor_Curve(edge)
+    u = (c.FirstParameter() + c.LastParameter()) / 2
+    p = OCC.gp.gp_Pnt()
+    t = OCC.gp.gp_Vec()
+    c.D1(u, p, t)
+    # Along the boundary of a face, the face lies to the left of the edge
+    # seen from outside; so a convex edge has (n1 x n2) along its direction
+    # as it is used in f1
+    for e in visit(f1, OCC.TopAbs.TopAbs_EDGE, OCC.TopoDS.topods.Edge):
+        if e.IsSame(edge):
+            if e.Orientation() == OCC.TopAbs.TopAbs_REVERSED: t.Reverse()
+            break
+    n1 = _normal_on_edge(f1, edge, u)
+    n2 = _normal_on_edge(f2, edge, u)
+    s = n1.Crossed(n2).Dot(t)
+    if s > tol: return 1
+    if s < -tol: return -1
+    return 0
+
+def _normal_on_edge(face, edge, u):
+    uv = OCC.BRepAdaptor.BRepAdaptor_Curve2d(edge, face).Value(u)
+    p = OCC.gp.gp_Pnt()
+    n = OCC.gp.gp_Vec()
+    OCC.BRepGProp.BRepGProp_Face(face).Normal(uv.X(), uv.Y(), p, n)
+    if n.Magnitude() > 0: n.Normalize()
+    return n
+
+def _masked(items, masks):
+    import numpy
+    keep = numpy.ones(len(items), bool)
+    for m in masks:
+        keep &= m
+    return [items[i] for i in numpy.flatnonzero(keep)]
+
+def _index(shape):
+    c = current_context()
+    if c.topology is None or c.topology.shape is not shape:
+        c.topology = TopologyIndex(shape)
+    return c.topology
+
+def Topology():
+    """Return the `TopologyIndex` of the current item
+
+The index is built once and reused until the current item changes, so
+that e.g. several `Chamfer` calls on the same item share its maps."""
+    return _index(Object())
+
+def AdjacentFaces(edge):
+    """Return the faces of the current item which contain `edge`"""
+    return Topology().adjacent_faces(edge)
+
+def EdgesBetween(face1, face2):
+    """Return the edges of the current item shared by `face1` and `face2`"""
+    return Topology().edges_between(face1, face2)
+
+def ConvexEdges():
+    """Return the edges of the current item at outside corners"""
+    t = Topology()
+    return t.select(t.convex())
+
+def ConcaveEdges():
+    """Return the edges of the current item at inside corners"""
+    t = Topology()
+    return t.select(t.concave())
+
 class Edge:
     @classmethod
     def createLine(cls, p1, p2):
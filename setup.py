@@ -9,6 +9,6 @@ setup(name='poc',
       author='Jeff Epler',
       author_email='jepler@gmail.com',
       url='https://github.com/jepler/poc',
-      py_modules=['poctools'],
+      py_modules=['poctools', 'pocserver'],
       scripts=['poc', 'pocview', 'pocimg'],
      )